@@ -0,0 +1,156 @@
+import numpy as np
+import cv2
+
+import datetime
+import json
+import os
+import resource
+import subprocess
+import time
+
+from keras.layers import Input, merge, Convolution2D, AveragePooling2D, UpSampling2D
+from keras.models import Model
+
+from util import save_pickle
+from util.meta import n_classes, image_border
+
+from model import band_size_factors, band_n_channels
+
+
+# Size of real I band tiles, other bands are derived by band size factor
+image_size = (3349, 3391)
+
+
+def synthetic_image(n_channels, size_factor=1, dtype=np.float64, border=True, smooth=False, seed=0):
+    rng = np.random.RandomState(seed)
+
+    h = int(round(image_size[0] / float(size_factor)))
+    w = int(round(image_size[1] / float(size_factor)))
+
+    if border:
+        h += 2 * image_border
+        w += 2 * image_border
+
+    if not smooth:
+        return (rng.rand(n_channels, h, w) * 2047).astype(dtype)
+
+    # Spatially coherent image, so predictions on it have blob-like structure
+    img = np.empty((n_channels, h, w), dtype=dtype)
+    for c in xrange(n_channels):
+        img[c] = cv2.resize(rng.rand(h // 32 + 2, w // 32 + 2).astype(np.float32) * 2047, (w, h), interpolation=cv2.INTER_CUBIC)
+
+    return img
+
+
+def synthetic_mask(n_blobs=300, border=False, seed=0):
+    rng = np.random.RandomState(seed)
+
+    h, w = image_size
+    mask = np.zeros((n_classes, h, w), dtype=np.float32)
+
+    for c in xrange(n_classes):
+        m = np.zeros((h, w), dtype=np.uint8)
+
+        for _ in xrange(n_blobs):
+            cv2.circle(m, (rng.randint(w), rng.randint(h)), rng.randint(3, 60), 1, -1)
+
+        mask[c] = m
+
+    if border:
+        mask = np.pad(mask, ((0, 0), (image_border, image_border), (image_border, image_border)), mode='constant')
+
+    return mask
+
+
+def tiny_arch(mask_patch_size):
+    # Stand-in model: bring every input to the size of the largest one, apply 1x1 convolution and scale to mask size
+    def arch(input_shapes, n_classes):
+        inputs = dict((name, Input(shape, name=name)) for name, shape in input_shapes.items())
+        size = max(shape[1] for shape in input_shapes.values())
+
+        scaled = []
+        for name, shape in sorted(input_shapes.items()):
+            if shape[1] < size:
+                scaled.append(UpSampling2D((size // shape[1], size // shape[1]))(inputs[name]))
+            else:
+                scaled.append(inputs[name])
+
+        x = merge(scaled, mode='concat', concat_axis=1) if len(scaled) > 1 else scaled[0]
+        x = Convolution2D(n_classes, 1, 1, activation='sigmoid')(x)
+
+        if size > mask_patch_size:
+            x = AveragePooling2D((size // mask_patch_size, size // mask_patch_size))(x)
+        elif size < mask_patch_size:
+            x = UpSampling2D((mask_patch_size // size, mask_patch_size // size))(x)
+
+        return Model(input=inputs.values(), output=x)
+
+    return arch
+
+
+def prepare_cache(image_ids, bands, masks=False):
+    # Synthetic image cache in current directory
+    for d in ['images', 'meta', 'masks', 'preds', 'models']:
+        os.makedirs(os.path.join('cache', d))
+
+    for i, image_id in enumerate(image_ids):
+        for band in bands:
+            np.save('cache/images/%s_%s.npy' % (image_id, band), synthetic_image(band_n_channels[band], band_size_factors[band], smooth=True, seed=i))
+
+        if masks:
+            np.save('cache/masks/%s.npy' % image_id, synthetic_mask(seed=i))
+
+        save_pickle('cache/meta/%s.pickle' % image_id, {'shape': (0, image_size[0], image_size[1])})
+
+
+def measure(fn, n_repeat=5):
+    times = []
+
+    for _ in xrange(n_repeat):
+        start_time = time.time()
+        fn()
+        times.append(time.time() - start_time)
+
+    return {'min': min(times), 'mean': float(np.mean(times)), 'n_repeat': n_repeat}
+
+
+def reset_peak_memory():
+    # Reset peak resident set size of process (linux only)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+
+def peak_memory():
+    # Peak resident set size in bytes since start or last reset
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(suite, results, filename=None):
+    if filename is None:
+        filename = 'bench/results/%s-%s.json' % (suite, datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+
+    with open(filename, 'w') as f:
+        json.dump({'suite': suite, 'revision': git_revision(), 'time': datetime.datetime.now().isoformat(), 'results': results}, f, indent=2, sort_keys=True)
+
+    print "Results saved to %s" % filename
@@ -0,0 +1,255 @@
+# Benchmarks data pipeline hot paths on synthetic rasters, doesn't need input data or model weights
+#
+# Usage: python -m bench.data [--output results.json]
+
+import numpy as np
+
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+
+from util.meta import n_classes
+from util.masks import mask_to_poly
+from util.stats import compute_band_stats, merge_band_stats
+from util.chunked import ChunkedArray, save_chunked, available_compressions
+from util.cache import LRUCache, array_cache
+
+from model import ModelPipeline, Augmenter, Normalizer, MeanStdNormalizer, band_size_factors, band_n_channels, extract_patch, upscale_mask
+
+from model.source import ImageWorkingSet
+
+from .common import synthetic_image, synthetic_mask, prepare_cache, measure, reset_peak_memory, peak_memory, save_results
+
+
+def no_model(input_shapes, n_classes):
+    # Generators and normalization don't need a model
+    return None
+
+
+def bench_extract_patch(images, n_patches):
+    results = {}
+
+    for band, patch_size, downscale in [('I', 128, 1), ('I', 128, 4), ('M', 32, 1), ('M', 128, 1)]:
+        img = images[band]
+        xx = np.zeros((n_patches, img.shape[0], patch_size, patch_size), dtype=np.float32)
+        offsets = np.random.rand(n_patches, 2)
+
+        def run():
+            for k in xrange(n_patches):
+                extract_patch(xx, img, k, offsets[k, 0], offsets[k, 1], patch_size, downscale)
+
+        res = measure(run)
+        res['patches_per_sec'] = n_patches / res['min']
+
+        results['%s_%d_x%d' % (band, patch_size, downscale)] = res
+
+    return results
+
+
+def bench_extract_patch_chunked(images, n_patches):
+    # Patch extraction from chunked images, with cold and warm chunk cache
+    results = {}
+
+    work_dir = tempfile.mkdtemp(prefix='bench-chunked-')
+
+    try:
+        for compression in available_compressions():
+            for band in ['I', 'M']:
+                save_chunked(os.path.join(work_dir, '%s.chunked' % band), images[band], compression=compression)
+
+            for band, patch_size in [('I', 128), ('M', 32)]:
+                img = images[band]
+                xx = np.zeros((n_patches, img.shape[0], patch_size, patch_size), dtype=np.float32)
+                offsets = np.random.rand(n_patches, 2)
+
+                def run(chunk_cache):
+                    chunked = ChunkedArray(os.path.join(work_dir, '%s.chunked' % band), chunk_cache)
+
+                    for k in xrange(n_patches):
+                        extract_patch(xx, chunked, k, offsets[k, 0], offsets[k, 1], patch_size, 1)
+
+                warm_cache = LRUCache(2**31)
+
+                res = {
+                    'cold': measure(lambda: run(None)),
+                    'warm': measure(lambda: run(warm_cache)),
+                    'file_bytes': os.path.getsize(os.path.join(work_dir, '%s.chunked' % band)),
+                    'array_bytes': img.nbytes,
+                }
+                res['cold']['patches_per_sec'] = n_patches / res['cold']['min']
+                res['warm']['patches_per_sec'] = n_patches / res['warm']['min']
+
+                results['%s_%d_%s' % (band, patch_size, compression or 'raw')] = res
+    finally:
+        shutil.rmtree(work_dir)
+
+    return results
+
+
+def bench_augment(batch_size):
+    results = {}
+
+    for name, opts in [('default', {}), ('rotation', {'rotation': 15, 'scale': 0.1})]:
+        augmenter = Augmenter(**opts)
+
+        x_batches = {
+            'in_I': np.random.rand(batch_size, 3, 128, 128).astype(np.float32),
+            'in_M': np.random.rand(batch_size, 8, 32, 32).astype(np.float32),
+        }
+        y_batch = np.random.rand(batch_size, n_classes, 128, 128).astype(np.float32)
+
+        res = measure(lambda: augmenter.augment_batch(x_batches, y_batch))
+        res['samples_per_sec'] = batch_size / res['min']
+
+        results[name] = res
+
+    return results
+
+
+def bench_generators(images, masks, batch_size, n_batches):
+    inputs = {'in_I': {'band': 'I'}, 'in_M': {'band': 'M'}}
+
+    pipeline = ModelPipeline('bench', no_model, mask_patch_size=128, inputs=inputs)
+    pipeline.input_normalizers = dict((name, Normalizer().fit(compute_band_stats(images[inp['band']]))) for name, inp in inputs.items())
+
+    image_ids = ['synthetic_%d' % i for i in xrange(len(masks))]
+    input_images = dict((name, [images[inp['band']]] * len(masks)) for name, inp in inputs.items())
+
+    generators = {
+        'grid': lambda: pipeline.grid_batch_generator(image_ids, input_images, masks, augmenter=Augmenter(), batch_size=batch_size),
+        'random': lambda: pipeline.random_batch_generator(image_ids, input_images, masks, augmenter=Augmenter(), batch_size=batch_size, batch_class_threshold=0, batch_noclass_accept_proba=0, batch_noclass_accept_proba_growth=0),
+        'random_threshold': lambda: pipeline.random_batch_generator(image_ids, input_images, masks, augmenter=Augmenter(), batch_size=batch_size, batch_class_threshold=np.array([100] * n_classes), batch_noclass_accept_proba=0.1, batch_noclass_accept_proba_growth=0),
+    }
+
+    results = {}
+
+    for name, make_generator in generators.items():
+        generator = make_generator()
+
+        res = measure(lambda: list(itertools.islice(generator, n_batches)), n_repeat=3)
+        res['samples_per_sec'] = n_batches * batch_size / res['min']
+
+        results[name] = res
+
+    return results
+
+
+def bench_working_set(n_images, max_images, batch_size, n_batches):
+    # Random batches with class threshold (so part of samples is rejected) from out-of-core working set of
+    # max_images of n_images vs the same number of images in memory, patch cost doesn't depend on number of
+    # in-memory images, but their memory does
+    inputs = {'in_I': {'band': 'I'}, 'in_M': {'band': 'M'}}
+    image_ids = ['synthetic_%d' % i for i in xrange(n_images)]
+
+    repo_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='bench-working-set-')
+
+    results = {}
+
+    try:
+        os.chdir(work_dir)
+        prepare_cache(image_ids, ['I', 'M'], masks=True)
+
+        pipeline = ModelPipeline('bench', no_model, mask_patch_size=128, inputs=inputs)
+        pipeline.fit_normalizers(image_ids)
+
+        def random_batches(batch_image_ids, input_images, masks, working_set=None):
+            generator = pipeline.random_batch_generator(batch_image_ids, input_images, masks, augmenter=Augmenter(), batch_size=batch_size, batch_class_threshold=np.array([100] * n_classes), batch_noclass_accept_proba=0.1, batch_noclass_accept_proba_growth=0, working_set=working_set)
+
+            res = measure(lambda: list(itertools.islice(generator, n_batches)), n_repeat=3)
+            res['samples_per_sec'] = n_batches * batch_size / res['min']
+
+            return res
+
+        reset_peak_memory()
+        results['in_memory'] = random_batches(image_ids[:max_images], pipeline.load_input_images(image_ids[:max_images]), pipeline.load_masks(image_ids[:max_images]))
+        results['in_memory'].update({'peak_memory': peak_memory(), 'n_images': max_images})
+
+        array_cache.clear()
+
+        reset_peak_memory()
+        working_set = ImageWorkingSet(pipeline, image_ids, max_images=max_images)
+        initial_loads = working_set.loads
+
+        results['working_set'] = random_batches(image_ids, working_set.input_images, working_set.masks, working_set)
+        results['working_set'].update({'peak_memory': peak_memory(), 'n_images': n_images, 'max_images': max_images, 'swap_every': working_set.swap_every, 'batches': working_set.batches, 'loads': working_set.loads - initial_loads})
+    finally:
+        os.chdir(repo_dir)
+        shutil.rmtree(work_dir)
+
+    return results
+
+
+def bench_normalizers(images, n_images):
+    results = {}
+
+    for band in ['I', 'M']:
+        img = images[band]
+
+        stats = [compute_band_stats(img)] * n_images
+        batch = np.random.rand(32, img.shape[0], 128, 128).astype(np.float32)
+
+        results[band] = {
+            'compute_stats': measure(lambda: compute_band_stats(img), n_repeat=3),
+            'merge_stats': measure(lambda: merge_band_stats(stats)),
+            'fit_minmax': measure(lambda: Normalizer().fit(merge_band_stats(stats))),
+            'fit_std': measure(lambda: MeanStdNormalizer().fit(merge_band_stats(stats))),
+            'transform': measure(lambda: Normalizer().fit(stats[0]).transform(img), n_repeat=3),
+            'transform_batch': measure(lambda: Normalizer().fit(stats[0]).transform_batch(batch.copy())),
+        }
+
+    return results
+
+
+def bench_upscale_mask():
+    results = {}
+
+    for n_channels, size, downscale in [(n_classes, 128, 4), (8 * n_classes, 128, 4), (n_classes, 64, 8)]:
+        m = np.random.rand(n_channels, size, size).astype(np.float32)
+
+        results['%d_%d_x%d' % (n_channels, size, downscale)] = measure(lambda: upscale_mask(m, downscale))
+
+    return results
+
+
+def bench_mask_to_poly(masks):
+    xymax = (0.009188, -0.00904)
+
+    return {
+        'class_0': measure(lambda: mask_to_poly(masks[0][0], xymax), n_repeat=3),
+    }
+
+
+parser = argparse.ArgumentParser(description='Benchmark data pipeline')
+parser.add_argument('--output', type=str, help='results file')
+parser.add_argument('--n-images', type=int, default=2, help='number of synthetic train images')
+parser.add_argument('--batch-size', type=int, default=32, help='batch size')
+parser.add_argument('--n-batches', type=int, default=20, help='number of batches to generate per run')
+parser.add_argument('--working-set-images', type=int, default=16, help='number of synthetic images in disk cache of working set benchmark')
+parser.add_argument('--working-set-size', type=int, default=2, help='number of resident images of working set benchmark')
+
+args = parser.parse_args()
+
+print "Generating synthetic data..."
+
+images = dict((band, synthetic_image(band_n_channels[band], band_size_factors[band])) for band in ['I', 'M'])
+masks = [synthetic_mask(border=True, seed=i) for i in xrange(args.n_images)]
+
+results = {}
+
+for name, fn in [
+    ('extract_patch', lambda: bench_extract_patch(images, n_patches=256)),
+    ('extract_patch_chunked', lambda: bench_extract_patch_chunked(images, n_patches=256)),
+    ('augment_batch', lambda: bench_augment(args.batch_size)),
+    ('batch_generators', lambda: bench_generators(images, masks, args.batch_size, args.n_batches)),
+    ('working_set', lambda: bench_working_set(args.working_set_images, args.working_set_size, args.batch_size, args.n_batches)),
+    ('normalizers', lambda: bench_normalizers(images, args.n_images)),
+    ('upscale_mask', lambda: bench_upscale_mask()),
+    ('mask_to_poly', lambda: bench_mask_to_poly(masks)),
+]:
+    print "Benchmarking %s..." % name
+    results[name] = fn()
+
+save_results('data', results, args.output)
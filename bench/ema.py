@@ -0,0 +1,80 @@
+# Measures per-batch overhead of EMA weight averaging
+#
+# Usage: python -m bench.ema [preset ...]
+
+import numpy as np
+
+import argparse
+import time
+
+from keras import backend as K
+
+from model import ModelPipeline
+from model.ema import ExponentialMovingAverage
+from model.presets import presets
+
+
+class HostExponentialMovingAverage(object):
+    # Previous implementation, copying all trainable weights to host every batch
+
+    def __init__(self, model, decay):
+        self.model = model
+        self.decay = decay
+        self.ema_trainable_weights_vals = {x.name: K.get_value(x) for x in model.trainable_weights}
+
+    def on_batch_end(self, batch, logs={}):
+        for w in self.model.trainable_weights:
+            old_val = self.ema_trainable_weights_vals[w.name]
+            new_val = K.get_value(w)
+
+            self.ema_trainable_weights_vals[w.name] -= (1.0 - self.decay) * (old_val - new_val)
+
+
+def random_batch(pipeline, batch_size):
+    x_batches = dict((name, np.random.rand(batch_size, inp.n_channels, inp.patch_size, inp.patch_size).astype(np.float32)) for name, inp in pipeline.inputs.items())
+    y_batch = (np.random.rand(batch_size, pipeline.n_classes, pipeline.mask_patch_size, pipeline.mask_patch_size) > 0.9).astype(np.float32)
+
+    return x_batches, y_batch
+
+
+def time_batches(model, x_batches, y_batch, n_batches, callback=None):
+    start_time = time.time()
+
+    for i in xrange(n_batches):
+        model.train_on_batch(x_batches, y_batch)
+
+        if callback is not None:
+            callback.on_batch_end(i)
+
+    return (time.time() - start_time) / n_batches
+
+
+parser = argparse.ArgumentParser(description='Benchmark EMA overhead')
+parser.add_argument('presets', type=str, nargs='*', default=['r5_cars', 'd8mi'], help='model presets to benchmark')
+parser.add_argument('--batch-size', type=int, default=8, help='batch size')
+parser.add_argument('--n-batches', type=int, default=20, help='number of timed batches')
+
+args = parser.parse_args()
+
+for preset_name in args.presets:
+    preset_opts = dict((k, v) for k, v in presets[preset_name].items() if k not in ['train', 'init'])
+
+    pipeline = ModelPipeline('bench-%s' % preset_name, **preset_opts)
+    pipeline.model.compile(optimizer='adam', loss='binary_crossentropy')
+
+    x_batches, y_batch = random_batch(pipeline, args.batch_size)
+
+    # Warm up
+    time_batches(pipeline.model, x_batches, y_batch, 2)
+
+    host_ema = HostExponentialMovingAverage(pipeline.model, decay=0.995)
+
+    backend_ema = ExponentialMovingAverage(decay=0.995)
+    backend_ema.set_model(pipeline.model)
+    backend_ema.on_train_begin()
+
+    base = time_batches(pipeline.model, x_batches, y_batch, args.n_batches)
+    host = time_batches(pipeline.model, x_batches, y_batch, args.n_batches, host_ema)
+    backend = time_batches(pipeline.model, x_batches, y_batch, args.n_batches, backend_ema)
+
+    print "%s (%d params): batch %.1f ms, host ema +%.1f ms, backend ema +%.1f ms" % (preset_name, pipeline.model.count_params(), base * 1000, (host - base) * 1000, (backend - base) * 1000)
@@ -0,0 +1,99 @@
+# End-to-end inference benchmark (predict -> mask_to_poly -> wkt) with a tiny stand-in model
+# on synthetic image cache, measures everything except the real model
+#
+# Usage: python -m bench.inference [preset ...]
+
+import numpy as np
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import shapely.wkt
+
+from util.masks import mask_to_poly
+
+from model import ModelPipeline, stitch_patches
+from model.presets import presets
+
+from .common import tiny_arch, prepare_cache, reset_peak_memory, peak_memory, save_results
+
+
+xymax = (0.009188, -0.00904)
+
+
+def bench_image(pipeline, image_id):
+    times = {}
+
+    def stage(name, fn):
+        start_time = time.time()
+        res = fn()
+        times[name] = time.time() - start_time
+        return res
+
+    reset_peak_memory()
+
+    meta, x = stage('load', lambda: pipeline.load_predict_inputs(image_id))
+    offsets = pipeline.grid_offsets(x[pipeline.coarse_input])
+
+    xbs = stage('extract', lambda: pipeline.extract_predict_patches(x, offsets))
+    stage('normalize', lambda: [pipeline.input_normalizers[name].transform_batch(xbs[name]) for name in pipeline.inputs])
+
+    pb = stage('forward', lambda: pipeline.predict_patches(xbs, pipeline.tta))
+    pred = stage('stitch', lambda: pipeline.expand_classes(stitch_patches(pb, offsets, meta['shape'][1:], pipeline.mask_downscale, pipeline.stitch_window)))
+
+    polys = stage('polygonize', lambda: [mask_to_poly(pred[cls], xymax) for cls in pipeline.classes])
+    wkts = stage('serialize', lambda: [shapely.wkt.dumps(poly, rounding_precision=8) for poly in polys])
+
+    return {
+        'stages': times,
+        'total': sum(times.values()),
+        'peak_memory': peak_memory(),
+        'n_patches': len(offsets),
+        'wkt_bytes': sum(len(w) for w in wkts),
+    }
+
+
+parser = argparse.ArgumentParser(description='Benchmark inference pipeline')
+parser.add_argument('presets', type=str, nargs='*', default=['r5_cars', 'd8mi', 'd8m'], help='model presets to take inputs and patch sizes from')
+parser.add_argument('--n-images', type=int, default=2, help='number of synthetic images')
+parser.add_argument('--output', type=str, help='results file')
+
+args = parser.parse_args()
+
+repo_dir = os.getcwd()
+work_dir = tempfile.mkdtemp(prefix='bench-inference-')
+
+results = {}
+
+try:
+    os.chdir(work_dir)
+
+    image_ids = ['synthetic_%d' % i for i in xrange(args.n_images)]
+    bands = sorted(set(inp['band'] for preset_name in args.presets for inp in presets[preset_name]['inputs'].values()))
+
+    print "Generating synthetic cache for bands %s..." % ', '.join(bands)
+    prepare_cache(image_ids, bands)
+
+    for preset_name in args.presets:
+        print "Benchmarking %s..." % preset_name
+
+        preset_opts = dict((k, v) for k, v in presets[preset_name].items() if k not in ['train', 'init', 'arch', 'arch_options'])
+
+        pipeline = ModelPipeline('bench-%s' % preset_name, tiny_arch(preset_opts['mask_patch_size']), **preset_opts)
+        pipeline.fit_normalizers(image_ids, pipeline.load_input_images(image_ids))
+
+        # Warm up
+        pipeline.predict_patches(dict((name, np.zeros((1, inp.n_channels, inp.patch_size, inp.patch_size), dtype=np.float32)) for name, inp in pipeline.inputs.items()))
+
+        results[preset_name] = dict((image_id, bench_image(pipeline, image_id)) for image_id in image_ids)
+
+        for image_id, res in sorted(results[preset_name].items()):
+            print "  %s: %s, total %.2f s, peak memory %d MB" % (image_id, ', '.join('%s %.2f s' % (k, res['stages'][k]) for k in ['load', 'extract', 'normalize', 'forward', 'stitch', 'polygonize', 'serialize']), res['total'], res['peak_memory'] // 2**20)
+finally:
+    os.chdir(repo_dir)
+    shutil.rmtree(work_dir)
+
+save_results('inference', results, args.output)
@@ -0,0 +1,117 @@
+# Data-parallel training scaling: short fits of preset on synthetic cache with 1, 2, 4, 8 worker
+# processes, reports training throughput and scaling efficiency (throughput / (workers * 1 worker throughput)).
+# Each worker count runs in a fresh python process, so backend threads can be split between workers.
+#
+# Usage: python -m bench.parallel [preset] [--workers 1 2 4 8] [--tiny]
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+parser = argparse.ArgumentParser(description='Benchmark data-parallel training')
+parser.add_argument('preset', type=str, nargs='?', default='r5_cars', help='model preset to take inputs and arch from')
+parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='worker process counts')
+parser.add_argument('--n-images', type=int, default=4, help='number of synthetic images')
+parser.add_argument('--n-epoch', type=int, default=3, help='epochs per run, throughput is taken from the last one')
+parser.add_argument('--epoch-batches', type=int, default=16, help='batches per epoch')
+parser.add_argument('--batch-size', type=int, default=64, help='global batch size, should be divisible by worker counts')
+parser.add_argument('--tiny', action='store_true', help='use tiny stand-in model instead of preset arch')
+parser.add_argument('--split-threads', action='store_true', help='limit backend threads of each worker to cores / workers')
+parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+parser.add_argument('--output', type=str, help='results file')
+
+args = parser.parse_args()
+
+
+def run(n_workers):
+    # Single measurement, runs in synthetic cache directory
+    from model import ModelPipeline
+    from model.presets import presets
+
+    from .common import tiny_arch
+
+    preset = presets[args.preset]
+    preset_opts = dict((k, v) for k, v in preset.items() if k not in ['train', 'init'])
+
+    if args.tiny:
+        preset_opts['arch'] = tiny_arch(preset_opts['mask_patch_size'])
+        preset_opts['arch_options'] = {}
+
+    image_ids = ['synthetic_%d' % i for i in xrange(args.n_images)]
+
+    pipeline = ModelPipeline('bench-%d' % n_workers, **preset_opts)
+    pipeline.fit(image_ids, n_epoch=args.n_epoch, epoch_batches=args.epoch_batches, batch_size=args.batch_size, n_workers=n_workers)
+
+    with open('cache/models/bench-%d-perf.csv' % n_workers) as f:
+        rows = list(csv.DictReader(f))
+
+    return {
+        'samples_per_sec': float(rows[-1]['samples_per_sec']),
+        'wait_fraction': float(rows[-1]['wait_fraction']),
+        'epochs': [float(row['samples_per_sec']) for row in rows],
+    }
+
+
+if args.run is not None:
+    with open('result.json', 'w') as f:
+        json.dump(run(args.run), f)
+
+    sys.exit(0)
+
+
+from model.presets import presets
+
+from .common import prepare_cache, save_results
+
+
+repo_dir = os.getcwd()
+work_dir = tempfile.mkdtemp(prefix='bench-parallel-')
+
+n_cores = multiprocessing.cpu_count()
+
+results = {}
+
+try:
+    image_ids = ['synthetic_%d' % i for i in xrange(args.n_images)]
+    bands = sorted(set(inp['band'] for inp in presets[args.preset]['inputs'].values()))
+
+    print "Generating synthetic cache for bands %s..." % ', '.join(bands)
+
+    os.chdir(work_dir)
+    prepare_cache(image_ids, bands, masks=True)
+
+    for n_workers in args.workers:
+        print "Training with %d workers..." % n_workers
+
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([repo_dir] + filter(None, [os.environ.get('PYTHONPATH')])))
+
+        if args.split_threads:
+            env['OMP_NUM_THREADS'] = str(max(n_cores // n_workers, 1))
+
+        if os.path.exists('result.json'):
+            os.remove('result.json')
+
+        subprocess.check_call([sys.executable, '-m', 'bench.parallel', args.preset, '--run', str(n_workers), '--n-images', str(args.n_images), '--n-epoch', str(args.n_epoch), '--epoch-batches', str(args.epoch_batches), '--batch-size', str(args.batch_size)] + (['--tiny'] if args.tiny else []), env=env)
+
+        with open('result.json') as f:
+            results[n_workers] = json.load(f)
+finally:
+    os.chdir(repo_dir)
+    shutil.rmtree(work_dir)
+
+base = results[min(results)]
+
+for n_workers, res in sorted(results.items()):
+    res['speedup'] = res['samples_per_sec'] / base['samples_per_sec'] * min(results)
+    res['efficiency'] = res['speedup'] / n_workers
+
+    print "  %d workers: %.1f samples/s, speedup %.2f, efficiency %.2f, wait fraction %.3f" % (n_workers, res['samples_per_sec'], res['speedup'], res['efficiency'], res['wait_fraction'])
+
+save_results('parallel', {'preset': args.preset, 'tiny': args.tiny, 'cores': n_cores, 'split_threads': args.split_threads, 'workers': results}, args.output)
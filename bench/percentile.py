@@ -0,0 +1,61 @@
+# Benchmarks location-wide percentile computation for MN band: np.percentile on full location
+# channels (float64 mosaic and uint16) vs histograms accumulated per tile
+#
+# Usage: python -m bench.percentile [--output results.json]
+
+import numpy as np
+
+import argparse
+
+from util.stats import uint16_histograms, histogram_percentile
+
+from model import band_size_factors, band_n_channels
+
+from .common import synthetic_image, measure, save_results
+
+
+n_location_images = 5
+
+q = [1, 99]
+
+
+parser = argparse.ArgumentParser(description='Benchmark location percentiles')
+parser.add_argument('--band', type=str, default='M', help='band to take size and channels from')
+parser.add_argument('--output', type=str, help='results file')
+
+args = parser.parse_args()
+
+# Synthetic location, split into 5x5 tiles
+location = synthetic_image(band_n_channels[args.band], band_size_factors[args.band] / float(n_location_images), dtype=np.uint16, border=False)
+tiles = [tile for row in np.array_split(location, n_location_images, axis=1) for tile in np.array_split(row, n_location_images, axis=2)]
+
+print "Location of shape %r, %d values per channel" % (location.shape, location[0].size)
+
+
+def percentile_float64():
+    return np.array([np.percentile(location[c].astype(np.float64), q) for c in xrange(location.shape[0])])
+
+
+def percentile_uint16():
+    return np.array([np.percentile(location[c], q) for c in xrange(location.shape[0])])
+
+
+def percentile_histogram():
+    hist = sum(uint16_histograms(tile) for tile in tiles)
+
+    return np.array([histogram_percentile(hist[c], q) for c in xrange(location.shape[0])])
+
+
+reference = percentile_float64()
+
+results = {}
+
+for name, fn in [('np_percentile_float64', percentile_float64), ('np_percentile_uint16', percentile_uint16), ('histogram', percentile_histogram)]:
+    res = measure(fn, n_repeat=3)
+    res['max_abs_error'] = float(np.abs(fn() - reference).max())
+
+    results[name] = res
+
+    print "  %s: %.3f s, max error %g" % (name, res['min'], res['max_abs_error'])
+
+save_results('percentile', results, args.output)
@@ -0,0 +1,56 @@
+# Measures patch stitching time on a full-size image
+#
+# Usage: python -m bench.stitch
+
+import numpy as np
+
+import argparse
+import time
+
+from math import ceil
+
+from model import make_stitch_window, stitch_patches, upscale_mask
+
+
+def stitch_patches_loop(pb, offsets, shape, classes, downscale):
+    # Previous implementation, unweighted with per-patch upscale
+    size = pb.shape[2] * downscale
+
+    p = np.zeros((len(classes), shape[0], shape[1]), dtype=np.float32)
+    c = np.zeros((len(classes), shape[0], shape[1]), dtype=np.float32)
+
+    for k, (oi, oj) in enumerate(offsets):
+        si = int(round(oi * (shape[0] - size)))
+        sj = int(round(oj * (shape[1] - size)))
+
+        p[classes, si:si+size, sj:sj+size] += pb[k] if downscale == 1 else upscale_mask(pb[k], downscale)
+        c[:, si:si+size, sj:sj+size] += 1
+
+    return p / c
+
+
+parser = argparse.ArgumentParser(description='Benchmark patch stitching')
+parser.add_argument('--size', type=int, default=3400, help='image size')
+parser.add_argument('--n-classes', type=int, default=10, help='number of classes')
+
+args = parser.parse_args()
+
+shape = (args.size, args.size)
+
+for mask_patch_size, mask_downscale in [(128, 1), (64, 4), (128, 4)]:
+    n_patches = int(ceil(3400.0 / (mask_patch_size - 16) / mask_downscale))
+    offsets = [(i / (n_patches - 1.0), j / (n_patches - 1.0)) for i in xrange(n_patches) for j in xrange(n_patches)]
+
+    pb = np.random.rand(len(offsets), args.n_classes, mask_patch_size, mask_patch_size).astype(np.float32)
+
+    start_time = time.time()
+    stitch_patches_loop(pb.copy(), offsets, shape, range(args.n_classes), mask_downscale)
+    loop_time = time.time() - start_time
+
+    window = make_stitch_window(mask_patch_size * mask_downscale, 'gaussian')
+
+    start_time = time.time()
+    stitch_patches(pb.copy(), offsets, shape, mask_downscale, window)
+    stitch_time = time.time() - start_time
+
+    print "%dx%d, patch %d, downscale %d, %d patches: loop %.2f s, weighted %.2f s" % (args.size, args.size, mask_patch_size, mask_downscale, len(offsets), loop_time, stitch_time)
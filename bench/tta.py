@@ -0,0 +1,39 @@
+# Measures patch prediction throughput for different numbers of test-time augmentation variants
+#
+# Usage: python -m bench.tta [preset ...]
+
+import numpy as np
+
+import argparse
+import time
+
+from model import ModelPipeline
+from model.presets import presets
+
+
+parser = argparse.ArgumentParser(description='Benchmark test-time augmentation cost')
+parser.add_argument('presets', type=str, nargs='*', default=['r5_cars', 'd8mi'], help='model presets to benchmark')
+parser.add_argument('--n-patches', type=int, default=64, help='number of patches to predict')
+
+args = parser.parse_args()
+
+for preset_name in args.presets:
+    preset_opts = dict((k, v) for k, v in presets[preset_name].items() if k not in ['train', 'init'])
+
+    pipeline = ModelPipeline('bench-%s' % preset_name, **preset_opts)
+
+    xbs = dict((name, np.random.rand(args.n_patches, inp.n_channels, inp.patch_size, inp.patch_size).astype(np.float32)) for name, inp in pipeline.inputs.items())
+
+    # Warm up
+    pipeline.predict_patches(xbs, 1)
+
+    base = None
+    for tta in [1, 2, 4, 8]:
+        start_time = time.time()
+        pipeline.predict_patches(xbs, tta)
+        elapsed = time.time() - start_time
+
+        if base is None:
+            base = elapsed
+
+        print "%s, tta=%d: %.1f patches/s, %.2fx time, %.2fx per variant" % (preset_name, tta, args.n_patches / elapsed, elapsed / base, elapsed / base / tta)
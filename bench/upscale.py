@@ -0,0 +1,37 @@
+# Checks multi-channel upscale_mask against per-channel resize and measures its speed
+#
+# Usage: python -m bench.upscale
+
+import numpy as np
+import cv2
+
+import time
+
+from model import upscale_mask
+
+
+def upscale_mask_loop(m, downscale):
+    # Previous implementation (with correct width/height order)
+    res = np.zeros((m.shape[0], m.shape[1]*downscale, m.shape[2]*downscale), dtype=np.float32)
+
+    for c in xrange(m.shape[0]):
+        res[c] = cv2.resize(m[c], (m.shape[2]*downscale, m.shape[1]*downscale), interpolation=cv2.INTER_LINEAR)
+
+    return res
+
+
+for shape, downscale in [((10, 128, 128), 4), ((4, 96, 96), 4), ((80, 64, 64), 4), ((10, 48, 80), 8), ((1, 30, 20), 2), ((700, 16, 24), 4)]:
+    m = np.random.rand(*shape).astype(np.float32)
+
+    start_time = time.time()
+    expected = upscale_mask_loop(m, downscale)
+    loop_time = time.time() - start_time
+
+    start_time = time.time()
+    res = upscale_mask(m, downscale)
+    resize_time = time.time() - start_time
+
+    assert res.shape == expected.shape, "Shape mismatch: %s vs %s" % (res.shape, expected.shape)
+    assert np.allclose(res, expected, atol=1e-6), "Value mismatch for %s" % str(shape)
+
+    print "%s x%d: loop %.2f ms, multi-channel %.2f ms" % (shape, downscale, loop_time * 1000, resize_time * 1000)
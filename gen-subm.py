@@ -1,10 +1,15 @@
-import numpy as np
-
+import argparse
 import datetime
 import shapely.wkt
 
 from util.masks import mask_to_poly
 from util.data import grid_sizes, sample_submission
+from util.preds import load_prediction
+
+parser = argparse.ArgumentParser(description='Generate submission from stored predictions')
+parser.add_argument('name', type=str, nargs='?', help='prediction name, predictions {image_id}-{name} are used; {image_id} ones written by predict.py by default')
+
+args = parser.parse_args()
 
 subm = sample_submission.copy()
 
@@ -15,9 +20,9 @@ for i in subm.index:
 
     print "  Processing %s / %d..." % (image_id, cls)
 
-    mask = np.load('cache/preds/%s.npy' % image_id)
+    mask = load_prediction(image_id if args.name is None else '%s-%s' % (image_id, args.name), cls - 1)
 
-    subm.loc[i, 'MultipolygonWKT'] = shapely.wkt.dumps(mask_to_poly(mask[cls - 1], xymax))
+    subm.loc[i, 'MultipolygonWKT'] = shapely.wkt.dumps(mask_to_poly(mask, xymax))
 
 print "Saving..."
 
@@ -1,22 +1,45 @@
 import numpy as np
 import cv2
 
+import multiprocessing
+import hashlib
+import os
+import Queue
+import time
+
 from math import ceil
 
 from util.meta import n_classes, image_border
 from util import load_pickle, save_pickle
+from util.stats import load_band_stats, merge_band_stats
+from util.preds import save_prediction
+from util.timing import span, timed
+from util.cache import LRUCache, load_image, load_mask, load_meta
+from util.pyramid import pyramid_levels
 
+from keras import backend as K
 from keras.callbacks import ModelCheckpoint, Callback
 from keras.optimizers import Adam
 
 from .objectives import combined_loss, jaccard_coef, jaccard_coef_int
 from .ema import ExponentialMovingAverage
+from .checkpoint import TrainingStateCheckpoint, load_training_state
+from .perf import GeneratorStats, ThroughputLogger
+from .source import ImageWorkingSet
+from .parallel import fit_data_parallel
 
 patch_offset_range = 0.5
 round_offsets = True
 
+# Read downscaled inputs and masks from prepared pyramid levels instead of resampling each patch
+use_pyramids = True
+
 debug = False
 
+# Normalized prediction patches of recently predicted images, reused when only model weights change.
+# During training it is filled only in the validation worker, which lives as long as the pipeline
+patch_cache = LRUCache(2 * 2**30)
+
 
 band_size_factors = {
     'I': 1,
@@ -24,6 +47,8 @@ band_size_factors = {
     'M': 4,
     'MN': 4,
     'MI': 4,
+    'MC': 4,
+    'P': 1,
     'A': 4
 }
 
@@ -33,6 +58,8 @@ band_n_channels = {
     'M': 8,
     'MN': 8,
     'MI': 3,
+    'MC': 1,
+    'P': 1,
     'A': 8
 }
 
@@ -64,15 +91,63 @@ class_smooths = np.array([
 ])
 
 
-def upscale_mask(m, downscale):
-    res = np.zeros((m.shape[0], m.shape[1]*downscale, m.shape[2]*downscale), dtype=np.float32)
+def upscale_mask(m, downscale, max_channels=512):
+    h, w = m.shape[1]*downscale, m.shape[2]*downscale
+    res = np.empty((m.shape[0], h, w), dtype=np.float32)
+
+    # Resize many channels at once in HWC layout, opencv supports up to 512 channels per image
+    for start in xrange(0, m.shape[0], max_channels):
+        chunk = cv2.resize(np.ascontiguousarray(np.rollaxis(m[start:start+max_channels], 0, 3), dtype=np.float32), (w, h), interpolation=cv2.INTER_LINEAR)
+
+        if chunk.ndim == 2:
+            chunk = chunk[:, :, np.newaxis]
 
-    for c in xrange(m.shape[0]):
-        res[c] = cv2.resize(m[c], (m.shape[1]*downscale, m.shape[2]*downscale), interpolation=cv2.INTER_LINEAR)
+        res[start:start+max_channels] = np.rollaxis(chunk, 2)
 
     return res
 
 
+def make_stitch_window(size, window):
+    if window == 'uniform':
+        return np.ones((size, size), dtype=np.float32)
+    elif window == 'gaussian':
+        # Weight patch centers more than borders, sigma is a quarter of patch size
+        r = (np.arange(size) - (size - 1) / 2.0) / (size / 4.0)
+        w = np.exp(-0.5 * r ** 2)
+
+        return np.maximum(np.outer(w, w), 1e-3).astype(np.float32)
+    else:
+        raise ValueError("Unknown stitch window: %s" % window)
+
+
+def stitch_patches(pb, offsets, shape, downscale, window, chunk_size=8):
+    # Weighted average of overlapping patch predictions, pb is modified in-place
+    size = pb.shape[2] * downscale
+
+    p = np.zeros((pb.shape[1], shape[0], shape[1]), dtype=np.float32)
+    c = np.zeros((shape[0], shape[1]), dtype=np.float32)
+
+    for start in xrange(0, len(offsets), chunk_size):
+        chunk = pb[start:start + chunk_size]
+
+        if downscale > 1:
+            n, nc = chunk.shape[:2]
+            chunk = upscale_mask(chunk.reshape((n * nc,) + chunk.shape[2:]), downscale).reshape((n, nc, size, size))
+
+        chunk *= window
+
+        for k, (oi, oj) in enumerate(offsets[start:start + chunk_size]):
+            si = int(round(oi * (shape[0] - size)))
+            sj = int(round(oj * (shape[1] - size)))
+
+            p[:, si:si+size, sj:sj+size] += chunk[k]
+            c[si:si+size, sj:sj+size] += window
+
+    p /= c
+
+    return p
+
+
 def extract_patch(xx, x, k, oi, oj, patch_size, downscale):
     si = int(round(oi*(x.shape[1] - 2*image_border - patch_size*downscale))) + image_border
     sj = int(round(oj*(x.shape[2] - 2*image_border - patch_size*downscale))) + image_border
@@ -84,6 +159,33 @@ def extract_patch(xx, x, k, oi, oj, patch_size, downscale):
             xx[k, c] = cv2.resize(x[c, si:si+patch_size*downscale, sj:sj+patch_size*downscale].astype(np.float32), (patch_size, patch_size), interpolation=cv2.INTER_AREA)
 
 
+def dihedral_transform(x, variant):
+    # Apply one of 8 dihedral transforms (bit 2 - transpose, bit 0 - mirror by x, bit 1 - mirror by y) to batch
+    if variant & 4:
+        x = np.swapaxes(x, 2, 3)
+
+    if variant & 1:
+        x = x[:, :, ::-1, :]
+
+    if variant & 2:
+        x = x[:, :, :, ::-1]
+
+    return x
+
+
+def dihedral_inverse(x, variant):
+    if variant & 2:
+        x = x[:, :, :, ::-1]
+
+    if variant & 1:
+        x = x[:, :, ::-1, :]
+
+    if variant & 4:
+        x = np.swapaxes(x, 2, 3)
+
+    return x
+
+
 class Augmenter(object):
 
     def __init__(self, channel_shift_range=0.0005, channel_scale_range=0.0001, mirror=True, transpose=True, rotation=0, scale=0):
@@ -140,52 +242,207 @@ class Augmenter(object):
                         x_batch[i, c] += np.random.uniform(-self.channel_shift_range, self.channel_shift_range)
 
 
+def validate(pipeline, image_ids):
+    class_intersections = np.zeros(n_classes, dtype=np.float64)
+    class_unions = np.zeros(n_classes, dtype=np.float64) + 1e-5
+
+    class_intersections_int = np.zeros(n_classes, dtype=np.float64)
+    class_unions_int = np.zeros(n_classes, dtype=np.float64) + 1e-5
+
+    weights_hash = pipeline.weights_hash()
+
+    for image_id in image_ids:
+        mask = load_mask(image_id, cache=True).astype(np.float64)
+
+        pred = pipeline.predict(image_id, cache_patches=True)
+        save_prediction('%s-%s' % (image_id, pipeline.name), pred, model=pipeline.name, weights_hash=weights_hash, classes=list(pipeline.classes))
+
+        pred = pred.astype(np.float64)
+        pred_int = pred > 0.5
+
+        inter = (pred * mask).sum(axis=(1, 2))
+        union = (pred + mask).sum(axis=(1, 2)) - inter
+
+        inter_int = (pred_int * mask).sum(axis=(1, 2))
+        union_int = (pred_int + mask).sum(axis=(1, 2)) - inter_int
+
+        class_intersections += inter
+        class_unions += union
+
+        class_intersections_int += inter_int
+        class_unions_int += union_int
+
+    return class_intersections / class_unions, class_intersections_int / class_unions_int
+
+
+def validation_worker(name, options, image_ids, tasks, results):
+    # Graph and session inherited from parent process are not fork-safe, so worker builds own model copy from scratch
+    if K.backend() == 'tensorflow':
+        K.clear_session()
+
+    pipeline = ModelPipeline(name, **options)
+
+    while True:
+        task = tasks.get()
+
+        if task is None:
+            break
+
+        stage, epoch, weights, input_normalizers = task
+
+        # Normalizers are refitted in every stage, patch cache is keyed by them, so it's still reused when they don't change
+        pipeline.input_normalizers = input_normalizers
+        pipeline.model.set_weights(weights)
+
+        results.put((stage, epoch) + validate(pipeline, image_ids))
+
+
+class ValidationWorker(object):
+    """Background validation process of pipeline. It's kept through all fit stages until
+       pipeline.stop_validation(), so its prediction patch cache is filled once and is the
+       only one pinned by validation. Weight snapshots are passed through bounded queue.
+       """
+
+    def __init__(self, pipeline, image_ids, max_pending=1):
+        self.image_ids = image_ids
+        self.pending = 0
+
+        self.tasks = multiprocessing.Queue(max_pending)
+        self.results = multiprocessing.Queue()
+
+        self.process = multiprocessing.Process(target=validation_worker, args=(pipeline.name, pipeline.options, image_ids, self.tasks, self.results))
+        self.process.daemon = True
+        self.process.start()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def submit(self, stage, epoch, weights, input_normalizers):
+        # Raises Queue.Full if previous validations are still pending
+        self.tasks.put_nowait((stage, epoch, weights, input_normalizers))
+        self.pending += 1
+
+    def get_result(self, timeout=None):
+        # Raises Queue.Empty if there's no finished validation
+        result = self.results.get_nowait() if timeout is None else self.results.get(timeout=timeout)
+        self.pending -= 1
+
+        return result
+
+    def stop(self, timeout=60):
+        if self.is_alive():
+            try:
+                self.tasks.put(None, timeout=timeout)
+            except Queue.Full:
+                pass
+
+        self.process.join(timeout=timeout)
+
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+
 class Validator(Callback):
 
-    def __init__(self, pipeline, image_ids):
+    def __init__(self, pipeline, image_ids, background=True, max_pending=1, filepath=None, stage=0, shutdown_timeout=3600):
         self.pipeline = pipeline
         self.image_ids = image_ids
-        self.image_masks = dict((image_id, np.load('cache/masks/%s.npy' % image_id)) for image_id in image_ids)
+        self.background = background
+        self.max_pending = max_pending
+        self.filepath = filepath
+        self.stage = stage
+        self.shutdown_timeout = shutdown_timeout
+
+    def on_train_begin(self, logs={}):
+        if not self.background:
+            return
+
+        worker = self.pipeline.validation_worker
+
+        # Worker of previous stage is reused unless it died or validates other images
+        if worker is None or not worker.is_alive() or worker.image_ids != self.image_ids:
+            if worker is not None:
+                worker.stop()
+
+            worker = self.pipeline.validation_worker = ValidationWorker(self.pipeline, self.image_ids, self.max_pending)
+
+        self.worker = worker
 
     def on_epoch_end(self, epoch, logs={}):
+        if self.background:
+            self.report_results()
+
         if (epoch+1) % 5 != 0:
             return
 
-        print
-        print "  Validating epoch %d.." % (epoch+1)
+        if self.background:
+            if not self.worker.is_alive():
+                print
+                print "  Skipping validation of epoch %d, validation worker died with exit code %s" % (epoch+1, self.worker.process.exitcode)
+                return
+
+            try:
+                self.worker.submit(self.stage, epoch, self.model.get_weights(), self.pipeline.input_normalizers)
+            except Queue.Full:
+                print
+                print "  Skipping validation of epoch %d, previous validation is still running" % (epoch+1)
+        else:
+            print
+            print "  Validating epoch %d.." % (epoch+1)
 
-        class_intersections = np.zeros(n_classes, dtype=np.float64)
-        class_unions = np.zeros(n_classes, dtype=np.float64) + 1e-5
+            class_jacs, class_jacs_int = validate(self.pipeline, self.image_ids)
 
-        class_intersections_int = np.zeros(n_classes, dtype=np.float64)
-        class_unions_int = np.zeros(n_classes, dtype=np.float64) + 1e-5
+            self.print_results(class_jacs, class_jacs_int)
+            self.log_results(self.stage, epoch, class_jacs, class_jacs_int)
 
-        for image_id in self.image_ids:
-            mask = self.image_masks[image_id].astype(np.float64)
+    def on_train_end(self, logs={}):
+        if not self.background:
+            return
 
-            pred = self.pipeline.predict(image_id).astype(np.float64)
-            pred_int = pred > 0.5
+        deadline = time.time() + self.shutdown_timeout
 
-            np.save('cache/preds/%s_%s.npy' % (image_id, self.pipeline.name), pred)
+        # Wait for pending validations, worker itself stays for next stages
+        while self.worker.pending > 0 and self.worker.is_alive() and time.time() < deadline:
+            self.report_results(timeout=1)
 
-            inter = (pred * mask).sum(axis=(1, 2))
-            union = (pred + mask).sum(axis=(1, 2)) - inter
+        self.report_results()
 
-            inter_int = (pred_int * mask).sum(axis=(1, 2))
-            union_int = (pred_int + mask).sum(axis=(1, 2)) - inter_int
+        if not self.worker.is_alive():
+            print "  Validation worker failed with exit code %s" % self.worker.process.exitcode
+        elif self.worker.pending > 0:
+            print "  Validation worker didn't finish in %d seconds, terminating it" % self.shutdown_timeout
+            self.worker.process.terminate()
 
-            class_intersections += inter
-            class_unions += union
+    def report_results(self, timeout=None):
+        while True:
+            try:
+                stage, epoch, class_jacs, class_jacs_int = self.worker.get_result(timeout)
+            except Queue.Empty:
+                return
 
-            class_intersections_int += inter_int
-            class_unions_int += union_int
+            print
+            print "  Validation of epoch %d:" % (epoch+1)
 
-        class_jacs = class_intersections / class_unions
-        class_jacs_int = class_intersections_int / class_unions_int
+            self.print_results(class_jacs, class_jacs_int)
+            self.log_results(stage, epoch, class_jacs, class_jacs_int)
 
+    def print_results(self, class_jacs, class_jacs_int):
         print "  Class jac: [%s], mean jac: %s" % (' '.join('%.5f' % j for j in class_jacs), class_jacs.mean())
         print "  Class jac_int: [%s], mean jac_int: %s" % (' '.join('%.5f' % j for j in class_jacs_int), class_jacs_int.mean())
 
+    def log_results(self, stage, epoch, class_jacs, class_jacs_int):
+        # Append to csv, means are over model classes, so runs of class-specific models can be compared
+        if self.filepath is None:
+            return
+
+        write_header = not os.path.exists(self.filepath)
+
+        with open(self.filepath, 'a') as f:
+            if write_header:
+                f.write('stage,epoch,jac,jac_int,class_jacs,class_jacs_int\n')
+
+            f.write('%d,%d,%.5f,%.5f,%s,%s\n' % (stage, epoch + 1, class_jacs[self.pipeline.classes].mean(), class_jacs_int[self.pipeline.classes].mean(), ' '.join('%.5f' % j for j in class_jacs), ' '.join('%.5f' % j for j in class_jacs_int)))
 
 class Input(object):
 
@@ -195,9 +452,13 @@ class Input(object):
         self.patch_size = patch_size
         self.n_channels = band_n_channels[band]
 
+        # Image is loaded at pyramid level, patches are downscaled only by the remaining factor
+        self.level = downscale if use_pyramids and downscale in pyramid_levels else 1
+        self.patch_downscale = downscale // self.level
+
     def round_offsets(self, oi, oj, img):
-        ni = img.shape[1] - self.patch_size * self.downscale
-        nj = img.shape[2] - self.patch_size * self.downscale
+        ni = img.shape[1] - self.patch_size * self.patch_downscale
+        nj = img.shape[2] - self.patch_size * self.patch_downscale
 
         oi = round(oi * ni) / ni
         oj = round(oj * nj) / nj
@@ -207,13 +468,9 @@ class Input(object):
 
 class Normalizer(object):
 
-    def fit(self, images):
-        self.mins = np.empty(images[0].shape[0])
-        self.maxs = np.empty(images[0].shape[0])
-
-        for c in xrange(images[0].shape[0]):
-            self.mins[c] = min(img[c].min() for img in images)
-            self.maxs[c] = max(np.percentile(img[c], 99) for img in images)
+    def fit(self, stats):
+        self.mins = stats['min'].copy()
+        self.maxs = stats['p99'].copy()
 
         return self
 
@@ -225,18 +482,19 @@ class Normalizer(object):
 
         return res
 
+    def transform_batch(self, batch):
+        # Normalize batch of patches in-place
+        batch -= self.mins[np.newaxis, :, np.newaxis, np.newaxis].astype(np.float32)
+        batch /= (self.maxs - self.mins)[np.newaxis, :, np.newaxis, np.newaxis].astype(np.float32)
 
-class MeanStdNormalizer(object):
+        return batch
 
-    def fit(self, images):
-        self.means = np.empty(images[0].shape[0])
-        self.stds = np.empty(images[0].shape[0])
 
-        for c in xrange(images[0].shape[0]):
-            vals = np.hstack(img[c].flatten() for img in images)
+class MeanStdNormalizer(object):
 
-            self.means[c] = vals.mean()
-            self.stds[c] = vals.std()
+    def fit(self, stats):
+        self.means = stats['mean'].copy()
+        self.stds = np.sqrt(stats['m2'] / stats['count'])
 
         return self
 
@@ -248,17 +506,37 @@ class MeanStdNormalizer(object):
 
         return res
 
+    def transform_batch(self, batch):
+        # Normalize batch of patches in-place
+        batch -= self.means[np.newaxis, :, np.newaxis, np.newaxis].astype(np.float32)
+        batch /= self.stds[np.newaxis, :, np.newaxis, np.newaxis].astype(np.float32)
+
+        return batch
+
+
+def normalizer_key(norm):
+    h = hashlib.md5(type(norm).__name__)
+
+    for name, value in sorted(norm.__dict__.items()):
+        h.update(name)
+        h.update(np.ascontiguousarray(value).data)
+
+    return h.hexdigest()
+
 
 class ModelPipeline(object):
 
-    def __init__(self, name, arch, mask_patch_size, inputs, mask_downscale=1, classes=range(n_classes), arch_options={}, normalization='minmax'):
+    def __init__(self, name, arch, mask_patch_size, inputs, mask_downscale=1, classes=range(n_classes), arch_options={}, normalization='minmax', tta=1, stitch_window='gaussian'):
         self.name = name
+        self.options = dict(arch=arch, mask_patch_size=mask_patch_size, inputs=inputs, mask_downscale=mask_downscale, classes=classes, arch_options=arch_options, normalization=normalization, tta=tta, stitch_window=stitch_window)
 
         self.inputs = dict((key, Input(mask_patch_size * mask_downscale / band_size_factors[inp['band']] / inp.get('downscale', 1), **inp)) for key, inp in inputs.items())
         self.coarse_input = max(self.inputs.keys(), key=lambda inp: band_size_factors[self.inputs[inp].band])
 
         self.mask_patch_size = mask_patch_size
         self.mask_downscale = mask_downscale
+        self.mask_level = mask_downscale if use_pyramids and mask_downscale in pyramid_levels else 1
+        self.mask_patch_downscale = mask_downscale // self.mask_level
 
         self.n_patches = int(ceil(3400.0 / (self.mask_patch_size - 16) / self.mask_downscale))
 
@@ -266,12 +544,23 @@ class ModelPipeline(object):
         self.n_classes = len(classes)
 
         self.normalization = normalization
+        self.tta = tta
+        self.stitch_window = make_stitch_window(mask_patch_size * mask_downscale, stitch_window)
+
+        # Background validation process, shared by fit stages
+        self.validation_worker = None
 
         # Initialize model
         input_shapes = dict((k, (i.n_channels, i.patch_size, i.patch_size)) for k, i in self.inputs.items())
 
         self.model = arch(input_shapes=input_shapes, n_classes=self.n_classes, **arch_options)
 
+    def stop_validation(self):
+        # Validation worker holds its own model and caches, so it's stopped after the last fit stage
+        if self.validation_worker is not None:
+            self.validation_worker.stop()
+            self.validation_worker = None
+
     def load(self):
         self.input_normalizers = load_pickle('cache/models/%s-norm.pickle' % self.name)
         self.load_weights(self.name)
@@ -279,33 +568,79 @@ class ModelPipeline(object):
     def load_weights(self, name):
         self.model.load_weights('cache/models/%s.hdf5' % name)
 
-    def fit(self, train_image_ids, val_image_ids=None, n_epoch=100, epoch_batches='grid', batch_size=64, augment={}, optimizer=None, loss_jac_weight=0.1, batch_class_threshold=0, class_weights=1.0, ema=False, batch_noclass_accept_proba=0, batch_noclass_accept_proba_growth=0):
+    def weights_hash(self):
+        h = hashlib.md5()
+        for w in self.model.get_weights():
+            h.update(np.ascontiguousarray(w).data)
+        return h.hexdigest()
+
+    def load_training_state(self):
+        return load_training_state('cache/models/%s-state.pickle' % self.name)
+
+    @timed('fit')
+    def fit(self, train_image_ids, val_image_ids=None, n_epoch=100, epoch_batches='grid', batch_size=64, augment={}, optimizer=None, loss_jac_weight=0.1, batch_class_threshold=0, class_weights=1.0, ema=False, batch_noclass_accept_proba=0, batch_noclass_accept_proba_growth=0, stage=0, resume_state=None, working_set=None, n_workers=1):
         print "Fitting normalizers..."
 
         augmenter = Augmenter(**augment)
 
-        train_input_images = self.load_input_images(train_image_ids)
-        train_masks = self.load_masks(train_image_ids)
+        with span('load'):
+            if working_set is None:
+                train_input_images = self.load_input_images(train_image_ids)
+                train_masks = self.load_masks(train_image_ids)
+                train_images = None
+            else:
+                if epoch_batches == 'grid':
+                    raise ValueError("Out-of-core training supports only random batches")
+
+                # Keep only working_set images in memory
+                train_images = ImageWorkingSet(self, train_image_ids, max_images=working_set)
+                train_input_images = train_images.input_images
+                train_masks = train_images.masks
 
-        self.fit_and_apply_normalizers(train_input_images)
+        with span('normalize'):
+            self.fit_normalizers(train_image_ids, train_input_images if working_set is None else None)
 
         print "Preparing batch generators..."
 
+        initial_epoch = 0
+
+        if resume_state is not None:
+            initial_epoch = resume_state['epoch']
+
+            if epoch_batches != 'grid':
+                batch_noclass_accept_proba += batch_noclass_accept_proba_growth * initial_epoch * epoch_batches
+
+            print "Resuming stage %d from epoch %d..." % (stage, initial_epoch)
+
+        generator_stats = GeneratorStats()
+
+        # Data-parallel workers each run own generator with their share of the batch
+        def make_generator(batch_size):
+            if epoch_batches == 'grid':
+                return self.grid_batch_generator(train_image_ids, train_input_images, train_masks, augmenter=augmenter, batch_size=batch_size, stats=generator_stats)
+            else:
+                return self.random_batch_generator(train_image_ids, train_input_images, train_masks, augmenter=augmenter, batch_size=batch_size, batch_class_threshold=batch_class_threshold, batch_noclass_accept_proba=batch_noclass_accept_proba, batch_noclass_accept_proba_growth=batch_noclass_accept_proba_growth, working_set=train_images, stats=generator_stats)
+
         if epoch_batches == 'grid':
-            generator = self.grid_batch_generator(train_image_ids, train_input_images, train_masks, augmenter=augmenter, batch_size=batch_size)
             n_samples = len(train_image_ids) * self.n_patches * self.n_patches
         else:
-            generator = self.random_batch_generator(train_image_ids, train_input_images, train_masks, augmenter=augmenter, batch_size=batch_size, batch_class_threshold=batch_class_threshold, batch_noclass_accept_proba=batch_noclass_accept_proba, batch_noclass_accept_proba_growth=batch_noclass_accept_proba_growth)
             n_samples = epoch_batches * batch_size
 
         print "Training model with %d params..." % self.model.count_params()
 
+        if ema:
+            checkpoint = ExponentialMovingAverage(decay=0.995, filepath='cache/models/%s.hdf5' % self.name)
+        else:
+            checkpoint = ModelCheckpoint('cache/models/%s.hdf5' % self.name, monitor='loss', save_best_only=False, save_weights_only=True)
+
         callbacks = [
-            ExponentialMovingAverage(decay=0.995, filepath='cache/models/%s.hdf5' % self.name) if ema else ModelCheckpoint('cache/models/%s.hdf5' % self.name, monitor='loss', save_best_only=False, save_weights_only=True),
+            checkpoint,
+            TrainingStateCheckpoint('cache/models/%s-state.pickle' % self.name, stage=stage, state=resume_state, ema=checkpoint if ema else None),
+            ThroughputLogger('cache/models/%s-perf.csv' % self.name, generator_stats, stage=stage),
         ]
 
         if val_image_ids is not None:
-            callbacks.append(Validator(self, val_image_ids))
+            callbacks.append(Validator(self, val_image_ids, filepath='cache/models/%s-jac.csv' % self.name, stage=stage))
 
         def loss(y, p):
             return combined_loss(y, p, class_smooths[self.classes], class_priors[self.classes], jac_weight=loss_jac_weight, class_weights=class_weights)
@@ -319,18 +654,37 @@ class ModelPipeline(object):
         if optimizer is None:
             optimizer = Adam(3e-3, decay=4e-4)
 
-        self.model.compile(optimizer=optimizer, loss=loss, metrics=[jac, jac_int])
+        compile_options = dict(loss=loss, metrics=[jac, jac_int])
 
-        self.model.fit_generator(
-            generator,
-            samples_per_epoch=n_samples,
-            nb_epoch=n_epoch, verbose=1,
-            callbacks=callbacks)
-        self.model.save_weights('cache/models/%s.hdf5' % self.name)
+        self.model.compile(optimizer=optimizer, **compile_options)
 
-    def fit_and_apply_normalizers(self, input_images):
+        with span('train'):
+            if n_workers > 1:
+                print "Training in %d data-parallel processes..." % n_workers
+
+                fit_data_parallel(self, make_generator, n_workers, batch_size, n_samples, n_epoch, initial_epoch, callbacks, compile_options)
+            else:
+                self.model.fit_generator(
+                    make_generator(batch_size),
+                    samples_per_epoch=n_samples,
+                    nb_epoch=n_epoch, verbose=1,
+                    callbacks=callbacks,
+                    initial_epoch=initial_epoch)
+
+        with span('write'):
+            self.model.save_weights('cache/models/%s.hdf5' % self.name)
+
+    def fit_normalizers(self, image_ids, input_images=None):
         self.input_normalizers = {}
-        for input_name, images in input_images.items():
+        for input_name, inp in self.inputs.items():
+            # Stats are of full resolution band, so level images can't be used to compute missing ones
+            if input_images is not None and inp.level == 1:
+                images = input_images[input_name]
+            else:
+                images = [None] * len(image_ids)
+
+            stats = merge_band_stats([load_band_stats(image_id, inp.band, img) for image_id, img in zip(image_ids, images)])
+
             if self.normalization == 'minmax':
                 norm = Normalizer()
             elif self.normalization == 'std':
@@ -338,76 +692,141 @@ class ModelPipeline(object):
             else:
                 raise ValueError("Unknown normalization: %s" % self.normalization)
 
-            self.input_normalizers[input_name] = norm.fit(images)
-
-            for i in xrange(len(images)):
-                images[i] = self.input_normalizers[input_name].transform(images[i])
+            self.input_normalizers[input_name] = norm.fit(stats)
 
         save_pickle('cache/models/%s-norm.pickle' % self.name, self.input_normalizers)
 
-    def predict(self, image_id):
-        meta = load_pickle('cache/meta/%s.pickle' % image_id)
-        xbs = {}
+    @timed('predict')
+    def predict(self, image_id, tta=None, cache_patches=False):
+        if cache_patches:
+            meta, offsets, xbs = self.cached_predict_patches(image_id)
+        else:
+            meta, offsets, xbs = self.prepare_predict_patches(image_id)
 
-        x = {}
-        for input_name, inp in self.inputs.items():
-            x[input_name] = self.input_normalizers[input_name].transform(np.load('cache/images/%s_%s.npy' % (image_id, inp.band)))
+        with span('forward'):
+            pb = self.predict_patches(xbs, tta or self.tta)
 
+        if debug:
+            self.write_batch_images(xbs, pb, [(0, i / (self.n_patches - 1.0), j / (self.n_patches - 1.0)) for i in xrange(self.n_patches) for j in xrange(self.n_patches)], [image_id], 'pred')
+
+        with span('stitch'):
+            p = stitch_patches(pb, offsets, meta['shape'][1:], self.mask_downscale, self.stitch_window)
+
+        return self.expand_classes(p)
+
+    def prepare_predict_patches(self, image_id, cache_inputs=False):
+        with span('load'):
+            meta, x = self.load_predict_inputs(image_id, cache_inputs)
+
+        with span('extract'):
+            offsets = self.grid_offsets(x[self.coarse_input])
+
+            xbs = self.extract_predict_patches(x, offsets)
+
+        with span('normalize'):
+            for input_name in self.inputs:
+                self.input_normalizers[input_name].transform_batch(xbs[input_name])
+
+        return meta, offsets, xbs
+
+    def cached_predict_patches(self, image_id):
+        key = (image_id, self.patch_config())
+        cached = patch_cache.get(key)
+
+        if cached is not None:
+            return cached
+
+        meta, offsets, xbs = self.prepare_predict_patches(image_id, cache_inputs=True)
+
+        for xb in xbs.values():
+            xb.flags.writeable = False  # Shared between predictions
+
+        return patch_cache.put(key, (meta, offsets, xbs))
+
+    def patch_config(self):
+        inputs = tuple(sorted((input_name, inp.band, inp.patch_size, inp.downscale, inp.level, normalizer_key(self.input_normalizers[input_name])) for input_name, inp in self.inputs.items()))
+
+        return (self.n_patches, self.coarse_input, round_offsets, inputs)
+
+    def load_predict_inputs(self, image_id, cache=False):
+        meta = load_meta(image_id)
+
+        x = {}
         for input_name, inp in self.inputs.items():
-            xb = np.zeros((self.n_patches * self.n_patches, x[input_name].shape[0], inp.patch_size, inp.patch_size), dtype=np.float32)
+            x[input_name] = load_image(image_id, inp.band, inp.level, cache)
 
-            k = 0
-            for i in xrange(self.n_patches):
-                for j in xrange(self.n_patches):
-                    oi = i / (self.n_patches - 1.0)
-                    oj = j / (self.n_patches - 1.0)
+        return meta, x
 
-                    if round_offsets:
-                        oi, oj = self.inputs[self.coarse_input].round_offsets(oi, oj, x[self.coarse_input])
+    def extract_predict_patches(self, x, offsets):
+        xbs = {}
 
-                    extract_patch(xb, x[input_name], k, oi, oj, inp.patch_size, inp.downscale)
+        for input_name, inp in self.inputs.items():
+            xb = np.zeros((len(offsets), x[input_name].shape[0], inp.patch_size, inp.patch_size), dtype=np.float32)
 
-                    k += 1
+            for k, (oi, oj) in enumerate(offsets):
+                extract_patch(xb, x[input_name], k, oi, oj, inp.patch_size, inp.patch_downscale)
 
             xbs[input_name] = xb
 
-        pb = self.model.predict(xbs, batch_size=32)
+        return xbs
 
-        if debug:
-            self.write_batch_images(xbs, pb, [(0, i / (self.n_patches - 1.0), j / (self.n_patches - 1.0)) for i in xrange(self.n_patches) for j in xrange(self.n_patches)], [image_id], 'pred')
+    def expand_classes(self, p):
+        if list(self.classes) == range(n_classes):
+            return p
 
-        p = np.zeros((n_classes, meta['shape'][1], meta['shape'][2]), dtype=np.float32)
-        c = np.zeros((n_classes, meta['shape'][1], meta['shape'][2]), dtype=np.float32)
+        res = np.zeros((n_classes,) + p.shape[1:], dtype=np.float32)
+        res[self.classes] = p
+
+        return res
+
+    def grid_offsets(self, coarse_img):
+        offsets = []
 
-        k = 0
         for i in xrange(self.n_patches):
             for j in xrange(self.n_patches):
                 oi = i / (self.n_patches - 1.0)
                 oj = j / (self.n_patches - 1.0)
 
                 if round_offsets:
-                    oi, oj = self.inputs[self.coarse_input].round_offsets(oi, oj, x[self.coarse_input])
+                    oi, oj = self.inputs[self.coarse_input].round_offsets(oi, oj, coarse_img)
 
-                si = int(round(oi * (meta['shape'][1] - self.mask_patch_size*self.mask_downscale)))
-                sj = int(round(oj * (meta['shape'][2] - self.mask_patch_size*self.mask_downscale)))
+                offsets.append((oi, oj))
 
-                p[self.classes, si:si+self.mask_patch_size*self.mask_downscale, sj:sj+self.mask_patch_size*self.mask_downscale] += pb[k] if self.mask_downscale == 1 else upscale_mask(pb[k], self.mask_downscale)
-                c[:, si:si+self.mask_patch_size*self.mask_downscale, sj:sj+self.mask_patch_size*self.mask_downscale] += 1
+        return offsets
 
-                k += 1
+    def predict_patches(self, xbs, tta=1, batch_size=32):
+        if tta == 1:
+            return self.model.predict(xbs, batch_size=batch_size)
+
+        n = xbs.values()[0].shape[0]
+        pb = np.empty((n, self.n_classes, self.mask_patch_size, self.mask_patch_size), dtype=np.float32)
 
-        return p / c
+        # Predict all tta variants of a chunk of patches as one batch and average inverted outputs
+        chunk_size = max(1, batch_size // tta)
+        for start in xrange(0, n, chunk_size):
+            end = min(start + chunk_size, n)
+            m = end - start
+
+            xb = dict((input_name, np.concatenate([dihedral_transform(x[start:end], v) for v in xrange(tta)])) for input_name, x in xbs.items())
+            yb = self.model.predict_on_batch(xb)
+
+            pb[start:end] = yb[:m]
+            for v in xrange(1, tta):
+                pb[start:end] += dihedral_inverse(yb[v*m:(v+1)*m], v)
+            pb[start:end] /= tta
+
+        return pb
 
     def load_input_images(self, image_ids):
         input_images = {}
         for input_name, inp in self.inputs.items():
-            input_images[input_name] = [np.load('cache/images/%s_%s.npy' % (image_id, inp.band)) for image_id in image_ids]
+            input_images[input_name] = [load_image(image_id, inp.band, inp.level, cache=True) for image_id in image_ids]
         return input_images
 
-    def load_masks(self, image_ids):
+    def load_masks(self, image_ids, cache=True):
         masks = []
         for image_id in image_ids:
-            mask = np.load('cache/masks/%s.npy' % image_id)
+            mask = load_mask(image_id, self.mask_level, cache)
 
             masks.append(np.zeros((self.n_classes, mask.shape[1] + 2 * image_border, mask.shape[2] + 2 * image_border), dtype=mask.dtype))
             masks[-1][:, image_border:mask.shape[1] + image_border, image_border:mask.shape[2] + image_border] = mask[self.classes]
@@ -421,7 +840,7 @@ class ModelPipeline(object):
                     cv2.imwrite("debug/%s/%s_%3f_%3f_%s.png" % (stage, image_ids[img_idx], oi, oj, inp.band), np.rollaxis(np.clip(x_batches[input_name][i, :3], 0, 1) * 255.0, 0, 3).astype(np.uint8))
                 cv2.imwrite("debug/%s/%s_%3f_%3f_mask.png" % (stage, image_ids[img_idx], oi, oj), np.rollaxis(np.clip(y_batch[i, [0, 1, 3]], 0, 1) * 255.0, 0, 3).astype(np.uint8))
 
-    def grid_batch_generator(self, image_ids, input_images, masks, augmenter, batch_size):
+    def grid_batch_generator(self, image_ids, input_images, masks, augmenter, batch_size, stats=None):
         while True:
             # Prepare index of patch locations
             patches = []
@@ -445,6 +864,7 @@ class ModelPipeline(object):
             # Iterate over patches
             batch_start = 0
             while batch_start < len(patches):
+                batch_time = time.time()
                 batch_patches = patches[batch_start:batch_start + batch_size]
 
                 x_batches = {}
@@ -454,8 +874,11 @@ class ModelPipeline(object):
 
                 for i, (img_idx, oi, oj) in enumerate(batch_patches):
                     for input_name, inp in self.inputs.items():
-                        extract_patch(x_batches[input_name], input_images[input_name][img_idx], i, oi, oi, inp.patch_size, inp.downscale)
-                    extract_patch(y_batch, masks[img_idx], i, oi, oj, self.mask_patch_size, self.mask_downscale)
+                        extract_patch(x_batches[input_name], input_images[input_name][img_idx], i, oi, oi, inp.patch_size, inp.patch_downscale)
+                    extract_patch(y_batch, masks[img_idx], i, oi, oj, self.mask_patch_size, self.mask_patch_downscale)
+
+                for input_name in self.inputs:
+                    self.input_normalizers[input_name].transform_batch(x_batches[input_name])
 
                 augmenter.augment_batch(x_batches, y_batch)
 
@@ -463,12 +886,17 @@ class ModelPipeline(object):
                 if debug:
                     self.write_batch_images(x_batches, y_batch, patches, image_ids, 'train')
 
+                if stats is not None:
+                    stats.add_batch(len(batch_patches), time.time() - batch_time)
+
                 yield x_batches, y_batch
 
                 batch_start += batch_size
 
-    def random_batch_generator(self, image_ids, input_images, masks, augmenter, batch_size, batch_class_threshold, batch_noclass_accept_proba, batch_noclass_accept_proba_growth):
+    def random_batch_generator(self, image_ids, input_images, masks, augmenter, batch_size, batch_class_threshold, batch_noclass_accept_proba, batch_noclass_accept_proba_growth, working_set=None, stats=None):
         while True:
+            batch_time = time.time()
+
             x_batches = {}
             for input_name, inp in self.inputs.items():
                 x_batches[input_name] = np.zeros((batch_size, inp.n_channels, inp.patch_size, inp.patch_size), dtype=np.float32)
@@ -479,7 +907,7 @@ class ModelPipeline(object):
             k = 0
             patches = []
             while k < batch_size:
-                img_idx = np.random.randint(len(masks))
+                img_idx = working_set.sample() if working_set is not None else np.random.randint(len(masks))
 
                 oi = np.random.uniform(0, 1)
                 oj = np.random.uniform(0, 1)
@@ -487,25 +915,36 @@ class ModelPipeline(object):
                 if round_offsets:
                     oi, oj = self.inputs[self.coarse_input].round_offsets(oi, oj, input_images[self.coarse_input][img_idx])
 
-                extract_patch(y_batch, masks[img_idx], k, oi, oj, self.mask_patch_size, self.mask_downscale)
+                extract_patch(y_batch, masks[img_idx], k, oi, oj, self.mask_patch_size, self.mask_patch_downscale)
 
                 # Skip image if it doesn't pass threshold and random acceptance
                 if all(y_batch[k].sum(axis=(1, 2)) < batch_class_threshold) and np.random.rand() > batch_noclass_accept_proba:
+                    if stats is not None:
+                        stats.add_rejected()
                     continue
 
                 for input_name, inp in self.inputs.items():
-                    extract_patch(x_batches[input_name], input_images[input_name][img_idx], k, oi, oj, inp.patch_size, inp.downscale)
+                    extract_patch(x_batches[input_name], input_images[input_name][img_idx], k, oi, oj, inp.patch_size, inp.patch_downscale)
 
                 patches.append((img_idx, oi, oj))
                 k += 1
 
-            # Augment them
+            # Normalize and augment them
+            for input_name in self.inputs:
+                self.input_normalizers[input_name].transform_batch(x_batches[input_name])
+
             augmenter.augment_batch(x_batches, y_batch)
 
             # Write debug images
             if debug:
                 self.write_batch_images(x_batches, y_batch, patches, image_ids, 'train')
 
+            if stats is not None:
+                stats.add_batch(batch_size, time.time() - batch_time)
+
             yield x_batches, y_batch
 
+            if working_set is not None:
+                working_set.next_batch()
+
             batch_noclass_accept_proba += batch_noclass_accept_proba_growth
@@ -0,0 +1,73 @@
+import cPickle as pickle
+import numpy as np
+import os
+
+from keras.callbacks import Callback
+
+
+def load_training_state(filepath):
+    if not os.path.exists(filepath):
+        return None
+
+    with open(filepath, 'rb') as f:
+        return pickle.load(f)
+
+
+class TrainingStateCheckpoint(Callback):
+    """Periodically saves everything needed to resume training mid-stage:
+       model and optimizer weights, EMA weights, epoch/stage counters and
+       numpy RNG state (used by batch generators). The file is replaced
+       atomically, so an interrupted save never corrupts the last state.
+       If `state` is given, it's restored at the beginning of training,
+       so callbacks which initialize themselves from model weights
+       (like EMA) should go before this one in callback list.
+       """
+    def __init__(self, filepath, stage=0, state=None, ema=None, period=1):
+        self.filepath = filepath
+        self.stage = stage
+        self.state = state
+        self.ema = ema
+        self.period = period
+
+        super(TrainingStateCheckpoint, self).__init__()
+
+    def on_train_begin(self, logs={}):
+        if self.state is None:
+            return
+
+        self.model.set_weights(self.state['weights'])
+        self.model.optimizer.set_weights(self.state['optimizer_weights'])
+
+        if self.ema is not None and self.state['ema'] is not None:
+            self.ema.cur_trainable_weights_vals = self.state['ema']['cur']
+            self.ema.ema_trainable_weights_vals = self.state['ema']['ema']
+            self.ema.ema_bias = self.state['ema'].get('bias', 0.0)  # Older states have averages seeded from weights, without bias
+
+        np.random.set_state(self.state['rng'])
+
+    def on_epoch_end(self, epoch, logs={}):
+        if (epoch + 1) % self.period != 0:
+            return
+
+        state = {
+            'stage': self.stage,
+            'epoch': epoch + 1,
+            'weights': self.model.get_weights(),
+            'optimizer_weights': self.model.optimizer.get_weights(),
+            'ema': None,
+            'rng': np.random.get_state(),
+        }
+
+        if self.ema is not None:
+            state['ema'] = {
+                'cur': self.ema.cur_trainable_weights_vals,
+                'ema': self.ema.ema_trainable_weights_vals,
+                'bias': self.ema.ema_bias,
+            }
+
+        tmp_filepath = self.filepath + '.tmp'
+
+        with open(tmp_filepath, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+
+        os.rename(tmp_filepath, self.filepath)
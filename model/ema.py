@@ -33,11 +33,21 @@ class ExponentialMovingAverage(Callback):
        averaged weights are transferred to the original model (so it may be
        used in later callbacks) and at the epoch beginning original weights
        are restored.
+       Moving averaged weights are kept as backend variables and updated
+       by a single backend function, so there is no device-host copy of the
+       weights on every batch. With update_every > 1 the update is applied
+       once per that many batches with decay ** update_every.
+       Averages start from zero and are debiased by the accumulated decay
+       (as in Adam), so early averages aren't pulled toward the initial
+       weights. They are kept with the model, so averaging continues over
+       training stages instead of restarting in each one.
        """
     def __init__(self, decay=0.999, filepath='temp_weight.hdf5',
                  save_ema_model=True, verbose=0,
-                 save_best_only=False, monitor='val_loss', mode='auto'):
+                 save_best_only=False, monitor='val_loss', mode='auto',
+                 update_every=1):
         self.decay = decay
+        self.update_every = update_every
         self.filepath = filepath
         self.verbose = verbose
         self.save_ema_model = save_ema_model
@@ -67,31 +77,73 @@ class ExponentialMovingAverage(Callback):
                 self.best = np.Inf
 
     def on_train_begin(self, logs={}):
-        # Initialize moving averaged weights using original model values
-        self.cur_trainable_weights_vals = {x.name: K.get_value(x) for x in self.model.trainable_weights}
-        self.ema_trainable_weights_vals = {x.name: K.get_value(x) for x in self.model.trainable_weights}
-        pass
+        weights = self.model.trainable_weights
+
+        self.cur_trainable_weights_vals = {w.name: v for w, v in zip(weights, K.batch_get_value(weights))}
+
+        # Moving averages live with the model, created on first use
+        if getattr(self.model, 'ema_trainable_weights', None) is None:
+            self.model.ema_trainable_weights = [K.zeros(K.int_shape(w)) for w in weights]
+            self.model.ema_bias = 1.0
+
+        self.ema_trainable_weights = self.model.ema_trainable_weights
+
+        decay = self.decay ** self.update_every
+        updates = [K.update(e, e - (1.0 - decay) * (e - w)) for e, w in zip(self.ema_trainable_weights, weights)]
+
+        self.ema_update = K.function([], [], updates=updates)
+        self.batches_since_update = 0
+
+    @property
+    def ema_bias(self):
+        # Product of decays of all updates, weight of zero initialization in raw averages
+        return self.model.ema_bias
+
+    @ema_bias.setter
+    def ema_bias(self, bias):
+        self.model.ema_bias = bias
+
+    @property
+    def ema_trainable_weights_vals(self):
+        # Raw (biased) averages, saved with ema_bias in training state
+        return {w.name: v for w, v in zip(self.model.trainable_weights, K.batch_get_value(self.ema_trainable_weights))}
+
+    @ema_trainable_weights_vals.setter
+    def ema_trainable_weights_vals(self, vals):
+        K.batch_set_value([(e, vals[w.name]) for e, w in zip(self.ema_trainable_weights, self.model.trainable_weights)])
+
+    def debiased_ema_vals(self):
+        weights = self.model.trainable_weights
+
+        if self.ema_bias >= 1.0:
+            return K.batch_get_value(weights)  # No updates yet
+
+        return [e / (1.0 - self.ema_bias) for e in K.batch_get_value(self.ema_trainable_weights)]
 
     def on_batch_end(self, batch, logs={}):
-        for w in self.model.trainable_weights:
-            old_val = self.ema_trainable_weights_vals[w.name]
-            new_val = K.get_value(w)
+        self.batches_since_update += 1
 
-            self.ema_trainable_weights_vals[w.name] -= (1.0 - self.decay) * (old_val - new_val)
+        if self.batches_since_update >= self.update_every:
+            self.ema_update([])
+            self.ema_bias *= self.decay ** self.update_every
+            self.batches_since_update = 0
 
     def on_epoch_begin(self, epoch, logs={}):
         """When starting each epoch, we restore model weights to their current values"""
 
-        for w in self.model.trainable_weights:
-            K.set_value(w, self.cur_trainable_weights_vals[w.name])
+        weights = self.model.trainable_weights
+        K.batch_set_value([(w, self.cur_trainable_weights_vals[w.name]) for w in weights])
 
     def on_epoch_end(self, epoch, logs={}):
         """After each epoch, we transfer ema weights to the model and optionally save it"""
 
         # Save current weights and replace them with ema
-        for w in self.model.trainable_weights:
-            self.cur_trainable_weights_vals[w.name] = K.get_value(w)
-            K.set_value(w, self.ema_trainable_weights_vals[w.name])
+        weights = self.model.trainable_weights
+        weight_vals = K.batch_get_value(weights)
+        ema_vals = self.debiased_ema_vals()
+
+        self.cur_trainable_weights_vals = {w.name: v for w, v in zip(weights, weight_vals)}
+        K.batch_set_value(zip(weights, ema_vals))
 
         if self.save_ema_model:
             filepath = self.filepath.format(epoch=epoch, **logs)
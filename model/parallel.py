@@ -0,0 +1,300 @@
+import numpy as np
+
+import ctypes
+import multiprocessing
+import threading
+import Queue
+
+from keras import backend as K
+from keras.callbacks import BaseLogger, ProgbarLogger, History, CallbackList
+
+
+class Barrier(object):
+    """Reusable barrier for forked processes (multiprocessing has none in python 2),
+       two turnstiles so fast process can't pass the next wait before others left this one.
+       """
+
+    def __init__(self, n, timeout=3600):
+        self.n = n
+        self.timeout = timeout
+        self.count = multiprocessing.Value('i', 0)
+        self.turnstiles = [multiprocessing.Semaphore(0), multiprocessing.Semaphore(0)]
+
+    def wait(self):
+        self.phase(self.turnstiles[0], 1, self.n)
+        self.phase(self.turnstiles[1], -1, 0)
+
+    def phase(self, turnstile, delta, release_count):
+        with self.count.get_lock():
+            self.count.value += delta
+
+            if self.count.value == release_count:
+                for _ in xrange(self.n):
+                    turnstile.release()
+
+        if not turnstile.acquire(timeout=self.timeout):
+            raise RuntimeError("Barrier timeout, some training worker probably died")
+
+
+class AllReduce(object):
+    """Averages float32 vectors over worker processes through shared memory: every
+       worker writes its vector to own slot, then reduces its own segment over all
+       slots into shared result, so reduction work is split between workers.
+       """
+
+    def __init__(self, n_workers, size, barrier):
+        self.n_workers = n_workers
+        self.size = size
+        self.barrier = barrier
+
+        self.slots = np.ctypeslib.as_array(multiprocessing.RawArray(ctypes.c_float, n_workers * size)).reshape((n_workers, size))
+        self.result = np.ctypeslib.as_array(multiprocessing.RawArray(ctypes.c_float, size))
+
+    def reduce(self, rank, values):
+        self.slots[rank] = values
+        self.barrier.wait()
+
+        lo = self.size * rank // self.n_workers
+        hi = self.size * (rank + 1) // self.n_workers
+
+        self.result[lo:hi] = self.slots[:, lo:hi].mean(axis=0)
+        self.barrier.wait()
+
+        return self.result.copy()
+
+
+class Channel(object):
+    # Shared state of data-parallel training: reductions of gradients and state weights, and stop flag
+
+    def __init__(self, model, n_workers):
+        self.n_workers = n_workers
+        self.barrier = Barrier(n_workers)
+
+        n_outputs = len(model.metrics_names)
+        n_params = sum(int(np.prod(K.int_shape(w))) for w in model.trainable_weights)
+        n_states = sum(int(np.prod(K.int_shape(w))) for w in model.non_trainable_weights)
+
+        self.gradients = AllReduce(n_workers, n_outputs + n_params, self.barrier)
+        self.states = AllReduce(n_workers, n_states, self.barrier) if n_states > 0 else None
+        self.stop = multiprocessing.Value('b', 0)
+
+
+def flatten(arrays):
+    return np.concatenate([np.ravel(a) for a in arrays]) if arrays else np.zeros(0, dtype=np.float32)
+
+
+def unflatten(values, shapes):
+    res = []
+    pos = 0
+
+    for shape in shapes:
+        size = int(np.prod(shape))
+        res.append(values[pos:pos+size].reshape(shape))
+        pos += size
+
+    return res
+
+
+class DataParallelWorker(object):
+    """Replica of compiled model in one training process. Training step is split to
+       gradient computation and optimizer update driven by reduced gradients, so all
+       replicas apply identical updates and their weights stay in sync.
+       """
+
+    def __init__(self, model, channel, rank):
+        self.model = model
+        self.channel = channel
+        self.rank = rank
+
+        params = model.trainable_weights
+        optimizer = model.optimizer
+
+        self.param_shapes = [K.int_shape(p) for p in params]
+        self.state_shapes = [K.int_shape(w) for w in model.non_trainable_weights]
+
+        self.inputs = model.inputs + model.targets + model.sample_weights
+        self.learning_phase = []
+
+        if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
+            self.inputs = self.inputs + [K.learning_phase()]
+            self.learning_phase = [1.]
+
+        # Gradients (clipped by optimizer if it's configured so) and model updates like batchnorm statistics
+        grads = optimizer.get_gradients(model.total_loss, params)
+
+        self.grad_fn = K.function(self.inputs, [model.total_loss] + model.metrics_tensors + grads, updates=model.updates)
+
+        # Optimizer takes gradients from placeholders fed with reduced values, get_gradients is
+        # replaced only while updates are built, so model optimizer is left as it was
+        grad_placeholders = [K.placeholder(shape=shape) for shape in self.param_shapes]
+        optimizer.get_gradients = lambda loss, params: grad_placeholders
+
+        try:
+            updates = optimizer.get_updates(params, model.constraints, model.total_loss)
+        finally:
+            del optimizer.get_gradients
+
+        self.apply_fn = K.function(grad_placeholders, [], updates=updates)
+
+        self.n_outputs = len(model.metrics_names)
+
+    def train_step(self, x, y):
+        x, y, sample_weights = self.model._standardize_user_data(x, y)
+
+        outs = self.grad_fn(x + y + sample_weights + self.learning_phase)
+
+        reduced = self.channel.gradients.reduce(self.rank, flatten([np.asarray(o, dtype=np.float32) for o in outs]))
+
+        self.apply_fn(unflatten(reduced[self.n_outputs:], self.param_shapes))
+
+        return dict(zip(self.model.metrics_names, [float(v) for v in reduced[:self.n_outputs]]))
+
+    def sync_states(self):
+        # Average non-trainable weights (batchnorm statistics), which are updated from local batches
+        if self.channel.states is None:
+            return
+
+        weights = self.model.non_trainable_weights
+        values = unflatten(self.channel.states.reduce(self.rank, flatten(K.batch_get_value(weights))), self.state_shapes)
+
+        K.batch_set_value(zip(weights, values))
+
+
+def prefetch(generator, max_size=10):
+    # Produce batches in background thread, like fit_generator does
+    queue = Queue.Queue(max_size)
+
+    def produce():
+        for item in generator:
+            queue.put(item)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        yield queue.get()
+
+
+def worker_main(rank, name, options, compile_options, optimizer_config, make_generator, batch_size, channel, init_queue, steps_per_epoch, n_epoch, initial_epoch):
+    from . import ModelPipeline
+
+    # Forked process inherits parent RNG state, so each worker needs own seed for distinct patch stream
+    np.random.seed()
+
+    # Graph and session inherited from parent process are not fork-safe, so worker builds own model copy from scratch
+    if K.backend() == 'tensorflow':
+        K.clear_session()
+
+    pipeline = ModelPipeline(name, **options)
+    pipeline.model.compile(optimizer=optimizer_config[0].from_config(optimizer_config[1]), **compile_options)
+
+    worker = DataParallelWorker(pipeline.model, channel, rank)
+
+    # Initial weights come from main process after its callbacks restored training state
+    weights, optimizer_weights = init_queue.get(timeout=channel.barrier.timeout)
+
+    pipeline.model.set_weights(weights)
+    pipeline.model.optimizer.set_weights(optimizer_weights)
+
+    batches = prefetch(make_generator(batch_size))
+
+    for epoch in xrange(initial_epoch, n_epoch):
+        for batch in xrange(steps_per_epoch):
+            worker.train_step(*next(batches))
+
+        worker.sync_states()
+
+        # Wait for epoch end callbacks of main process, which may stop training
+        channel.barrier.wait()
+
+        if channel.stop.value:
+            break
+
+
+def fit_data_parallel(pipeline, make_generator, n_workers, batch_size, n_samples, n_epoch, initial_epoch, callbacks, compile_options):
+    """Synchronous data-parallel training in n_workers processes, this one being rank 0 and
+       running callbacks. Each process trains on batch_size / n_workers patches from own
+       generator per step, gradients are averaged over processes, so step is equivalent
+       to one batch_size step of fit_generator. Workers are forked before training functions
+       of this process are built, and get initial weights through a queue.
+       """
+
+    model = pipeline.model
+
+    if batch_size % n_workers != 0:
+        raise ValueError("Batch size %d is not divisible by number of workers %d" % (batch_size, n_workers))
+
+    worker_batch_size = batch_size // n_workers
+    steps_per_epoch = n_samples // batch_size
+
+    channel = Channel(model, n_workers)
+    init_queue = multiprocessing.Queue()
+
+    optimizer_config = (model.optimizer.__class__, model.optimizer.get_config())
+
+    workers = []
+    for rank in xrange(1, n_workers):
+        p = multiprocessing.Process(target=worker_main, args=(rank, pipeline.name, pipeline.options, compile_options, optimizer_config, make_generator, worker_batch_size, channel, init_queue, steps_per_epoch, n_epoch, initial_epoch))
+        p.daemon = True
+        p.start()
+
+        workers.append(p)
+
+    try:
+        worker = DataParallelWorker(model, channel, 0)
+
+        model.history = History()
+        model.stop_training = False
+
+        callbacks = CallbackList([BaseLogger()] + callbacks + [model.history, ProgbarLogger()])
+        callbacks.set_model(model)
+        callbacks.set_params({
+            'nb_epoch': n_epoch,
+            'nb_sample': steps_per_epoch * batch_size,
+            'verbose': 1,
+            'do_validation': False,
+            'metrics': model.metrics_names,
+        })
+
+        # Callbacks may restore training state, so replicas are started from weights after it
+        callbacks.on_train_begin()
+
+        for _ in workers:
+            init_queue.put((model.get_weights(), model.optimizer.get_weights()))
+
+        batches = prefetch(make_generator(worker_batch_size))
+
+        for epoch in xrange(initial_epoch, n_epoch):
+            callbacks.on_epoch_begin(epoch)
+
+            for batch in xrange(steps_per_epoch):
+                x, y = next(batches)
+
+                batch_logs = {'batch': batch, 'size': batch_size}
+                callbacks.on_batch_begin(batch, batch_logs)
+
+                batch_logs.update(worker.train_step(x, y))
+                callbacks.on_batch_end(batch, batch_logs)
+
+            worker.sync_states()
+
+            epoch_logs = {}
+            callbacks.on_epoch_end(epoch, epoch_logs)
+
+            channel.stop.value = int(model.stop_training)
+            channel.barrier.wait()
+
+            if model.stop_training:
+                break
+    except:
+        for p in workers:
+            p.terminate()
+        raise
+
+    for p in workers:
+        p.join()
+
+    callbacks.on_train_end()
+
+    return model.history
@@ -0,0 +1,101 @@
+import csv
+import ctypes
+import multiprocessing
+import os
+import time
+
+from keras.callbacks import Callback
+
+
+class GeneratorStats(object):
+    """Counters updated by batch generators, which run in separate thread. Counters are
+       in shared memory, so generators of forked data-parallel workers add to them too.
+       """
+
+    def __init__(self):
+        self.lock = multiprocessing.Lock()
+        self.counters = multiprocessing.RawArray(ctypes.c_double, 4)  # batches, samples, rejected, produce time
+
+    def add_batch(self, n_samples, produce_time):
+        with self.lock:
+            self.counters[0] += 1
+            self.counters[1] += n_samples
+            self.counters[3] += produce_time
+
+    def add_rejected(self, n=1):
+        with self.lock:
+            self.counters[2] += n
+
+    def snapshot(self):
+        with self.lock:
+            batches, samples, rejected, produce_time = self.counters[:]
+
+        return int(batches), int(samples), int(rejected), produce_time
+
+
+class ThroughputLogger(Callback):
+    """Logs per-epoch training throughput to csv: time spent in train steps vs
+       waiting for batches from generator queue, and generator production
+       time and rejection counts. High wait fraction means training is
+       data-bound.
+       """
+
+    fields = ['stage', 'epoch', 'time', 'samples', 'samples_per_sec', 'step_time', 'wait_time', 'wait_fraction', 'gen_batches', 'gen_batch_time', 'gen_rejected', 'gen_rejection_rate']
+
+    def __init__(self, filepath, generator_stats, stage=0):
+        self.filepath = filepath
+        self.generator_stats = generator_stats
+        self.stage = stage
+
+        super(ThroughputLogger, self).__init__()
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self.epoch_start = time.time()
+        self.last_mark = self.epoch_start
+        self.step_time = 0.0
+        self.wait_time = 0.0
+        self.samples = 0
+        self.gen_start = self.generator_stats.snapshot()
+
+    def on_batch_begin(self, batch, logs={}):
+        now = time.time()
+
+        self.wait_time += now - self.last_mark
+        self.last_mark = now
+
+    def on_batch_end(self, batch, logs={}):
+        now = time.time()
+
+        self.step_time += now - self.last_mark
+        self.samples += logs.get('size', 0)
+        self.last_mark = now
+
+    def on_epoch_end(self, epoch, logs={}):
+        elapsed = time.time() - self.epoch_start
+
+        batches, samples, rejected, produce_time = [e - s for e, s in zip(self.generator_stats.snapshot(), self.gen_start)]
+
+        row = {
+            'stage': self.stage,
+            'epoch': epoch + 1,
+            'time': '%.3f' % elapsed,
+            'samples': self.samples,
+            'samples_per_sec': '%.2f' % (self.samples / elapsed),
+            'step_time': '%.3f' % self.step_time,
+            'wait_time': '%.3f' % self.wait_time,
+            'wait_fraction': '%.4f' % (self.wait_time / max(self.wait_time + self.step_time, 1e-12)),
+            'gen_batches': batches,
+            'gen_batch_time': '%.4f' % (produce_time / max(batches, 1)),
+            'gen_rejected': rejected,
+            'gen_rejection_rate': '%.4f' % (float(rejected) / max(rejected + samples, 1)),
+        }
+
+        write_header = not os.path.exists(self.filepath)
+
+        with open(self.filepath, 'a') as f:
+            writer = csv.DictWriter(f, self.fields)
+
+            if write_header:
+                writer.writeheader()
+
+            writer.writerow(row)
@@ -0,0 +1,99 @@
+import numpy as np
+
+import threading
+
+from collections import OrderedDict
+
+from util.cache import open_image
+
+
+class ImageWorkingSet(object):
+    """Out-of-core training images. At most max_images images with their masks are resident
+       in memory; inputs are read from disk-backed storage (memory-mapped or chunked) when
+       image enters the working set. Masks bypass array cache, so memory of evicted images
+       is freed. Patches are sampled only from resident images, and every swap_every batches
+       least recently used image is replaced by a random non-resident one, so image loads
+       are bounded per batch (regardless of rejected samples) while the working set slowly
+       cycles through all images.
+
+       Exposes input_images and masks as lazy per-image sequences, so batch generators
+       use it the same way as in-memory image lists.
+       """
+
+    def __init__(self, pipeline, image_ids, max_images=32, swap_every=20):
+        self.pipeline = pipeline
+        self.image_ids = image_ids
+        self.max_images = max_images
+        self.swap_every = swap_every
+
+        self.resident = OrderedDict()
+        self.lock = threading.Lock()
+        self.loads = 0
+        self.batches = 0
+
+        self.input_images = dict((input_name, ResidentImages(self, input_name)) for input_name in pipeline.inputs)
+        self.masks = ResidentImages(self, None)
+
+        # Start with random working set
+        for img_idx in np.random.permutation(len(image_ids))[:max_images]:
+            self.get(img_idx)
+
+    def sample(self):
+        with self.lock:
+            resident = self.resident.keys()
+
+        return resident[np.random.randint(len(resident))]
+
+    def next_batch(self):
+        # Called by batch generator after each batch, swaps one image every swap_every batches
+        self.batches += 1
+
+        if self.batches % self.swap_every != 0:
+            return
+
+        with self.lock:
+            outside = [img_idx for img_idx in xrange(len(self.image_ids)) if img_idx not in self.resident]
+
+        if outside:
+            self.get(outside[np.random.randint(len(outside))])
+
+    def get(self, img_idx):
+        with self.lock:
+            if img_idx in self.resident:
+                item = self.resident.pop(img_idx)
+                self.resident[img_idx] = item
+                return item
+
+            item = self.load(img_idx)
+
+            while len(self.resident) >= self.max_images:
+                self.resident.popitem(last=False)
+
+            self.resident[img_idx] = item
+            self.loads += 1
+
+            return item
+
+    def load(self, img_idx):
+        image_id = self.image_ids[img_idx]
+
+        inputs = dict((input_name, np.array(open_image(image_id, inp.band, inp.level))) for input_name, inp in self.pipeline.inputs.items())
+        mask = self.pipeline.load_masks([image_id], cache=False)[0]
+
+        return inputs, mask
+
+
+class ResidentImages(object):
+    # Sequence of one input (or masks, if input_name is None) of working set images
+
+    def __init__(self, working_set, input_name):
+        self.working_set = working_set
+        self.input_name = input_name
+
+    def __len__(self):
+        return len(self.working_set.image_ids)
+
+    def __getitem__(self, img_idx):
+        inputs, mask = self.working_set.get(img_idx)
+
+        return mask if self.input_name is None else inputs[self.input_name]
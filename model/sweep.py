@@ -0,0 +1,84 @@
+import numpy as np
+
+import itertools
+
+from collections import OrderedDict
+
+from keras.optimizers import Adam, SGD, RMSprop
+
+
+# Names available in grid value expressions
+grid_namespace = {'np': np, 'Adam': Adam, 'SGD': SGD, 'RMSprop': RMSprop}
+
+
+def parse_grid(specs):
+    """Parses grid options of form 'path=value1,value2,...' to ordered dict of value lists.
+       Path is dot-separated, with integer indices and '*' (all items) for lists, for example
+       'train.*.loss_jac_weight=0.1,0.5' or 'train.0.optimizer.lr=1e-3,3e-4'. Values are
+       python expressions (optimizers and numpy arrays are allowed), or strings if they
+       don't parse.
+       """
+
+    grid = OrderedDict()
+
+    for spec in specs:
+        path, values = spec.split('=', 1)
+
+        try:
+            grid[path] = list(eval('[%s]' % values, dict(grid_namespace)))
+        except Exception:
+            grid[path] = values.split(',')
+
+    return grid
+
+
+def with_option(obj, path, value):
+    # Copy of preset part with option at path replaced, containers along path are copied, so base preset is not modified
+    if not path:
+        return value
+
+    key, rest = path[0], path[1:]
+
+    if isinstance(obj, list):
+        res = list(obj)
+
+        for i in (xrange(len(obj)) if key == '*' else [int(key)]):
+            res[i] = with_option(obj[i], rest, value)
+
+        return res
+    elif isinstance(obj, dict):
+        res = dict(obj)
+        res[key] = with_option(obj.get(key, {}), rest, value)
+
+        return res
+    elif hasattr(obj, 'get_config'):
+        # Keras optimizer, rebuilt from modified config
+        config = obj.get_config()
+        config[key] = with_option(config.get(key), rest, value)
+
+        return obj.__class__.from_config(config)
+    else:
+        raise ValueError("Can't set option %s of %r" % (key, obj))
+
+
+def expand_preset(base, grid):
+    # List of (params, preset) for every combination of grid values, in stable order
+    variants = []
+
+    for values in itertools.product(*grid.values()):
+        params = OrderedDict(zip(grid.keys(), values))
+        preset = base
+
+        for path, value in params.items():
+            preset = with_option(preset, path.split('.'), value)
+
+        variants.append((params, preset))
+
+    return variants
+
+
+def format_param(value):
+    if hasattr(value, 'get_config'):
+        return '%s(%s)' % (value.__class__.__name__, ', '.join('%s=%g' % (k, v) for k, v in sorted(value.get_config().items()) if isinstance(v, (int, float))))
+
+    return str(value)
@@ -5,11 +5,13 @@ import sys
 
 from util.masks import poly_to_mask, mask_to_poly
 from util.data import grid_sizes
+from util.preds import load_prediction
+from util.cache import load_image, load_mask
 
 
 def plot_prediction(image_id, pred_id, cls=0):
-    image = np.load('cache/images/%s.npy' % image_id)
-    pred = np.load('cache/preds/%s.npy' % image_id)
+    image = load_image(image_id, 'I', cache=True)
+    pred = load_prediction(image_id, cls)
 
     xymax = (grid_sizes.loc[image_id, 'xmax'], grid_sizes.loc[image_id, 'ymin'])
 
@@ -20,19 +22,19 @@ def plot_prediction(image_id, pred_id, cls=0):
     ax1.imshow(image[1, :, :], cmap=plt.get_cmap('gray'))
     ax2 = plt.subplot(132)
     ax2.set_title('predict bldg pixels')
-    ax2.imshow(pred[cls], cmap=plt.get_cmap('hot'))
+    ax2.imshow(pred, cmap=plt.get_cmap('hot'))
     ax3 = plt.subplot(133)
     ax3.set_title('predict bldg polygones')
-    ax3.imshow(poly_to_mask(mask_to_poly(pred[cls], xymax), image.shape[1:], xymax), cmap=plt.get_cmap('hot'))
+    ax3.imshow(poly_to_mask(mask_to_poly(pred, xymax), image.shape[1:], xymax), cmap=plt.get_cmap('hot'))
 
     plt.title("%s - class %d" % (pred_id, cls))
     plt.show()
 
 
 def plot_all_class_predictions(image_id, pred_id):
-    image = np.load('cache/images/%s_I.npy' % image_id)
-    mask = np.load('cache/masks/%s.npy' % image_id)
-    pred = np.load('cache/preds/%s.npy' % pred_id)
+    image = np.asarray(load_image(image_id, 'I', cache=True))
+    mask = load_mask(image_id, cache=True)
+    pred = load_prediction(pred_id, range(9))
 
     f, ax = plt.subplots(2, 5, sharex='col', sharey='row')
 
@@ -47,11 +49,11 @@ def plot_all_class_predictions(image_id, pred_id):
 
 
 def plot_class_prediction(image_id, pred_id, c):
-    mask = np.load('cache/masks/%s.npy' % image_id)
-    pred = np.load('cache/preds/%s.npy' % pred_id)
+    mask = load_mask(image_id, cache=True)
+    pred = load_prediction(pred_id, c)
 
     plt.title("%s - class %d" % (pred_id, c))
-    plt.imshow(np.dstack((mask[c], pred[c], np.zeros(mask[c].shape))))
+    plt.imshow(np.dstack((mask[c], pred, np.zeros(mask[c].shape))))
     plt.show()
 
 
@@ -7,6 +7,7 @@ import argparse
 
 from util.data import grid_sizes, train_wkt
 from util.masks import convert_geo_coords_to_raster, poly_to_mask
+from util.cache import load_image as load_cached_image
 
 from matplotlib.patches import Polygon
 
@@ -38,7 +39,7 @@ cls_alphas = {
 
 
 def load_image(image_id):
-    img = np.load('cache/images/%s_I.npy' % image_id).astype(np.float32)
+    img = load_cached_image(image_id, 'I', cache=True).astype(np.float32)
 
     for c in xrange(img.shape[0]):
         l, h = np.percentile(img[c], [1, 99])
@@ -9,19 +9,15 @@ import shapely.wkt
 from util.data import grid_sizes, sample_submission, train_wkt
 from util.masks import mask_to_poly, poly_to_mask
 from util.meta import n_classes, full_train_image_ids, class_names
+from util.cache import load_image
+from util.preds import save_prediction
 
 
 min_water_area = 0.03
 
 
 def predict_mask(image_id):
-    m = np.load('cache/images/%s_M.npy' % image_id).astype(np.float64)
-
-    #r = m[4]
-    re = m[5]
-    mir = m[7]
-
-    ccci = - (mir - re) / (mir + re)
+    ccci = load_image(image_id, 'MC')[0]
 
     msk = (ccci > 0.11).astype(np.uint8)
 
@@ -103,6 +99,8 @@ if True:
         sys.stdout.flush()
 
         pred = predict_mask(image_id)
+        save_prediction('%s-water2' % image_id, pred, dtype='uint8', model='water2', classes=classes)
+
         xymax = (grid_sizes.loc[image_id, 'xmax'], grid_sizes.loc[image_id, 'ymin'])
 
         for cls in subm.loc[subm['ImageId'] == image_id, 'ClassType'].unique():
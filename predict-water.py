@@ -9,12 +9,14 @@ import shapely.wkt
 from util.data import grid_sizes, sample_submission, train_wkt
 from util.masks import mask_to_poly, poly_to_mask
 from util.meta import n_classes, full_train_image_ids, class_names
+from util.cache import load_image
+from util.preds import save_prediction
 
 from skimage.morphology import disk, binary_dilation
 
 
 def predict_mask(image_id):
-    mi = np.load('cache/images/%s_MI.npy' % image_id)
+    mi = load_image(image_id, 'MI')
 
     return binary_dilation(mi[1] < 0, disk(3))[np.newaxis, :, :].astype(np.uint8)
 
@@ -82,6 +84,8 @@ if True:
         sys.stdout.flush()
 
         pred = predict_mask(image_id)
+        save_prediction('%s-water' % image_id, pred, dtype='uint8', model='water', classes=classes)
+
         xymax = (grid_sizes.loc[image_id, 'xmax'], grid_sizes.loc[image_id, 'ymin'])
 
         for cls in subm.loc[subm['ImageId'] == image_id, 'ClassType'].unique():
@@ -8,6 +8,9 @@ import shapely.wkt
 
 from util.data import grid_sizes, sample_submission, train_wkt
 from util.masks import mask_to_poly
+from util.timing import span
+from util.cache import load_mask
+from util.preds import save_prediction
 from util.meta import n_classes, val_test_image_ids, class_names
 
 from model import ModelPipeline
@@ -43,6 +46,7 @@ if True:
     print "Validation pass, loading models..."
 
     models = dict(zip(model_names, [load_model(m, 'val') for m in model_names]))
+    weights_hashes = dict((m, models[m].weights_hash()) for m in model_names)
 
     print "Validating..."
 
@@ -58,8 +62,10 @@ if True:
         sys.stdout.write("  Processing %s... " % image_id)
         sys.stdout.flush()
 
-        mask = np.load('cache/masks/%s.npy' % image_id)
+        mask = load_mask(image_id)
         pred = combine(dict(zip(model_names, [models[m].predict(image_id) for m in model_names])))
+        save_prediction('%s-multi' % image_id, pred, model='multi', models=model_names, weights_hashes=weights_hashes)
+
         xymax = (grid_sizes.loc[image_id, 'xmax'], grid_sizes.loc[image_id, 'ymin'])
 
         for cls in xrange(n_classes):
@@ -92,6 +98,7 @@ if True:
     print "Full pass, loading models..."
 
     models = dict(zip(model_names, [load_model(m, 'full') for m in model_names]))
+    weights_hashes = dict((m, models[m].weights_hash()) for m in model_names)
 
     print "Predicting..."
 
@@ -104,6 +111,10 @@ if True:
         sys.stdout.flush()
 
         pred = combine(dict(zip(model_names, [models[m].predict(image_id) for m in model_names])))
+
+        # Default prediction of image, used by gen-subm.py
+        save_prediction(image_id, pred, model='multi', models=model_names, weights_hashes=weights_hashes)
+
         xymax = (grid_sizes.loc[image_id, 'xmax'], grid_sizes.loc[image_id, 'ymin'])
 
         for cls in subm.loc[subm['ImageId'] == image_id, 'ClassType'].unique():
@@ -118,7 +129,8 @@ if True:
     sys.stdout.flush()
 
     subm_name = 'subm-%s-%s' % ('multi', datetime.datetime.now().strftime('%Y%m%d-%H%M'))
-    subm.to_csv('subm/%s.csv.gz' % subm_name, index=False, compression='gzip')
+    with span('write'):
+        subm.to_csv('subm/%s.csv.gz' % subm_name, index=False, compression='gzip')
 
     print "Submission name: %s" % subm_name
 
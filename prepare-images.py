@@ -1,5 +1,10 @@
 from util.meta import locations, image_border
-from util import load_pickle, save_pickle
+from util import save_pickle
+from util.stats import save_band_stats, uint16_histograms, histogram_percentile
+from util.indices import compute_index_bands
+from util.pyramid import pyramid_levels, downscale_image
+from util.cache import save_image
+from util.timing import timed, pop_spans, add_spans
 
 from skimage.filters import sobel
 from joblib import Parallel, delayed
@@ -8,157 +13,259 @@ import tifffile as tiff
 import numpy as np
 import cv2
 
+import os
+import shutil
+import tempfile
+
 n_location_images = 5
 
+# Write images in chunked compressed format (util.chunked), for image sets not fitting in memory
+chunked_images = False
 
-def normalize(src):
-    dst = np.empty(shape=src.shape, dtype=np.float32)
 
-    for c in xrange(src.shape[0]):
-        l, h = np.percentile(src[c], [1, 99])
+class LocationTiles(object):
+    """Tiles of one location band, processed one at a time instead of stitching whole location mosaic.
 
-        dst[c] = (src[c].astype(np.float64) - l) / (h - l)
+       First pass over tiles records their shapes and edge strips of width margin, so later
+       any tile can be read with border of up to margin pixels taken from neighbour tiles,
+       exactly as if it was cut from the location mosaic with replicated outer border.
 
-    return dst
+       If resample_to is given, each tile is resampled to shape of the matching tile of
+       other LocationTiles, so bands of different resolution are aligned on its grid.
+       Resampled tiles are spilled to temporary directory in the first pass, so each tile
+       is resampled only once; close() removes them.
+       """
 
+    def __init__(self, loc, directory, band=None, resample_to=None, margin=image_border + 1, collect_histograms=False):
+        self.loc = loc
+        self.directory = directory
+        self.suffix = '_' + band if band is not None else ''
+        self.resample_to = resample_to
+        self.margin = margin
 
-def resize(src, shape):
-    dst = np.empty(shape=(src.shape[0], shape[0], shape[1]))
+        self.shapes = {}
+        self.strips = {}
+        self.histograms = None
 
-    for c in xrange(src.shape[0]):
-        dst[c] = cv2.resize(src[c], (shape[1], shape[0]), interpolation=cv2.INTER_CUBIC)
+        self.spill_dir = tempfile.mkdtemp(prefix='tiles-%s%s-' % (loc, self.suffix)) if resample_to is not None else None
+        self.spilled = {}
 
-    return dst
+        for i in xrange(n_location_images):
+            for j in xrange(n_location_images):
+                img = self.read_tile(i, j)
 
+                if self.spill_dir is not None:
+                    self.spilled[i, j] = os.path.join(self.spill_dir, '%d_%d.npy' % (i, j))
+                    np.save(self.spilled[i, j], img)
 
-def add_border(src):
-    dst = np.empty(shape=(src.shape[0], src.shape[1] + 2 * image_border, src.shape[2] + 2 * image_border))
+                self.shapes[i, j] = img.shape
+                self.strips[i, j] = (img[:, :margin].copy(), img[:, -margin:].copy(), img[:, :, :margin].copy(), img[:, :, -margin:].copy())
 
-    for c in xrange(src.shape[0]):
-        dst[c] = cv2.copyMakeBorder(src[c], top=image_border, bottom=image_border, left=image_border, right=image_border, borderType=cv2.BORDER_REPLICATE)
+                if collect_histograms:
+                    hist = uint16_histograms(img)
+                    self.histograms = hist if self.histograms is None else self.histograms + hist
 
-    return dst
+        self.n_channels = self.shapes[0, 0][0]
 
+        self.ys = [0]
+        self.xs = [0]
 
-def read_location_images(loc, directory, band=None, resize_to=None):
-    if band is not None:
-        suffix = '_' + band
-    else:
-        suffix = ''
+        for i in xrange(n_location_images):
+            assert len(set(self.shapes[i, j][1] for j in xrange(n_location_images))) == 1
+            self.ys.append(self.ys[i] + self.shapes[i, 0][1])
 
-    imgs = []
+        for i in xrange(n_location_images):
+            assert len(set(self.shapes[j, i][2] for j in xrange(n_location_images))) == 1
+            self.xs.append(self.xs[i] + self.shapes[0, i][2])
 
-    # Prepare images
-    for i in xrange(n_location_images):
-        imgs.append([])
+    @timed('load')
+    def read_tile(self, i, j):
+        if (i, j) in self.spilled:
+            return np.load(self.spilled[i, j])
 
-        for j in xrange(n_location_images):
-            img = tiff.imread('../input/%s/%s_%d_%d%s.tif' % (directory, loc, i, j, suffix))
+        img = tiff.imread('../input/%s/%s_%d_%d%s.tif' % (self.directory, self.loc, i, j, self.suffix))
 
-            if len(img.shape) == 2:
-                img = img[np.newaxis, :, :]
+        if len(img.shape) == 2:
+            img = img[np.newaxis, :, :]
 
-            if resize_to is not None:
-                meta = load_pickle('cache/meta/%s_%d_%d.pickle' % (loc, i, j))
-                img = resize(img, meta[resize_to][1:])
+        if self.resample_to is not None:
+            img = resample(img, self.resample_to.tile_shape(i, j))
 
-            imgs[i].append(img)
+        return img
 
-    ys = [0]
-    xs = [0]
+    def close(self):
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir)
+            self.spill_dir = None
+            self.spilled = {}
 
-    for i in xrange(n_location_images):
-        assert len(set(imgs[i][j].shape[1] for j in xrange(n_location_images))) == 1
-        ys.append(ys[i] + imgs[i][0].shape[1])
+    def tile_shape(self, i, j):
+        return self.shapes[i, j][1:]
 
-    for i in xrange(n_location_images):
-        assert len(set(imgs[j][i].shape[2] for j in xrange(n_location_images))) == 1
-        xs.append(xs[i] + imgs[0][i].shape[2])
+    def percentiles(self, q):
+        return np.array([histogram_percentile(self.histograms[c], q) for c in xrange(self.n_channels)]).T
 
-    data = np.zeros((imgs[0][0].shape[0], ys[-1], xs[-1]), dtype=np.uint16)
+    def read_window(self, i, j, border=image_border):
+        assert border <= self.margin
 
-    # Copy image data to the matrix
-    for i in xrange(n_location_images):
-        for j in xrange(n_location_images):
-            data[:, ys[i]:ys[i+1], xs[j]:xs[j+1]] = imgs[i][j]
+        ys, xs = self.ys, self.xs
 
-    # Add border by replicating image data
-    data = add_border(data)
+        y0, y1 = ys[i] - border, ys[i+1] + border
+        x0, x1 = xs[j] - border, xs[j+1] + border
 
-    return data, xs, ys
+        # Clip window to location, clipped part is filled by replication
+        cy0, cy1 = max(y0, 0), min(y1, ys[-1])
+        cx0, cx1 = max(x0, 0), min(x1, xs[-1])
 
+        data = np.empty((self.n_channels, cy1 - cy0, cx1 - cx0), dtype=np.uint16)
+        data[:, ys[i]-cy0:ys[i+1]-cy0, xs[j]-cx0:xs[j+1]-cx0] = self.read_tile(i, j)
 
-def write_location_images(loc, data, xs, ys, band, filters=False):
-    # Save images
-    for i in xrange(n_location_images):
-        for j in xrange(n_location_images):
-            np.save('cache/images/%s_%d_%d_%s.npy' % (loc, i, j, band), data[:, ys[i]:ys[i+1] + 2 * image_border, xs[j]:xs[j+1] + 2 * image_border])
+        # Copy border parts from neighbour tile strips
+        for ni in xrange(max(i-1, 0), min(i+2, n_location_images)):
+            for nj in xrange(max(j-1, 0), min(j+2, n_location_images)):
+                if ni == i and nj == j:
+                    continue
 
-    # Save debug location map
-    if False:
-        cv2.imwrite("%s.png" % loc, np.rollaxis((data - data.min()) * 255.0 / (data.max() - data.min()), 0, 3).astype(np.uint8))
+                ry0, ry1 = max(cy0, ys[ni]), min(cy1, ys[ni+1])
+                rx0, rx1 = max(cx0, xs[nj]), min(cx1, xs[nj+1])
 
+                if ry0 < ry1 and rx0 < rx1:
+                    data[:, ry0-cy0:ry1-cy0, rx0-cx0:rx1-cx0] = self.strip_region(ni, nj, ry0 - ys[ni], ry1 - ys[ni], rx0 - xs[nj], rx1 - xs[nj])
 
-def compute_filters(data):
-    filter_data = np.zeros((1, data.shape[1], data.shape[2]), dtype=np.float32)
-    filter_data[0] = sobel(np.clip(data[0] / 600.0, 0, 1)) + sobel(np.clip(data[1] / 600.0, 0, 1)) + sobel(np.clip(data[2] / 600.0, 0, 1))
+        if (cy0, cy1, cx0, cx1) != (y0, y1, x0, x1):
+            data = np.pad(data, ((0, 0), (cy0 - y0, y1 - cy1), (cx0 - x0, x1 - cx1)), mode='edge')
 
-    return filter_data
+        return data
+
+    def strip_region(self, i, j, r0, r1, c0, c1):
+        h, w = self.tile_shape(i, j)
+        top, bottom, left, right = self.strips[i, j]
+        m = self.margin
+
+        if r1 <= m:
+            return top[:, r0:r1, c0:c1]
+        elif r0 >= h - m:
+            return bottom[:, r0-h+m:r1-h+m, c0:c1]
+        elif c1 <= m:
+            return left[:, r0:r1, c0:c1]
+        elif c0 >= w - m:
+            return right[:, r0:r1, c0-w+m:c1-w+m]
 
+        raise ValueError("Region %r is not in tile %d_%d strips" % ((r0, r1, c0, c1), i, j))
 
-def compute_indices(m):
-    eps = 1e-3
 
-    blue = m[1].astype(np.float64)
-    green = m[2].astype(np.float64)
-    red = m[4].astype(np.float64)
+def crop(src, size):
+    return src[:, size:src.shape[1]-size, size:src.shape[2]-size]
 
-    nir1 = m[6].astype(np.float64)
 
-    indices_data = np.zeros((3, m.shape[1], m.shape[2]), dtype=np.float32)
-    indices_data[0] = (green - nir1) / (nir1 + green + eps)  # ndwi - nir1, green
-    indices_data[1] = (nir1 - red) / (nir1 + red + eps)  # ndvi - nir1, red
-    indices_data[2] = (nir1 - blue) / (nir1 + blue + eps)  # bai - nir1, blue
+@timed('normalize')
+def normalize(src, low, high):
+    dst = np.empty(shape=src.shape, dtype=np.float32)
 
-    return indices_data
+    for c in xrange(src.shape[0]):
+        dst[c] = (src[c].astype(np.float64) - low[c]) / (high[c] - low[c])
 
+    return dst
 
+
+@timed('resample')
+def resample(src, shape):
+    if shape[0] * shape[1] > src.shape[1] * src.shape[2]:
+        # Upsample all channels in one call, cv2 drops channel axis of single-channel images
+        dst = cv2.resize(np.rollaxis(src, 0, 3).astype(np.float32), (shape[1], shape[0]), interpolation=cv2.INTER_CUBIC)
+        dst = np.rollaxis(dst.reshape((shape[0], shape[1], src.shape[0])), 2, 0)
+    else:
+        # Area averaging supports at most 4 channels per call
+        dst = np.array([cv2.resize(src[c].astype(np.float32), (shape[1], shape[0]), interpolation=cv2.INTER_AREA) for c in xrange(src.shape[0])])
+
+    return np.ascontiguousarray(np.clip(np.round(dst), 0, 2**16 - 1).astype(np.uint16))
+
+
+@timed('write')
+def write_tile_image(image_id, band, tile):
+    save_image(image_id, band, tile, chunked=chunked_images)
+    save_band_stats(image_id, band, tile)  # Precompute normalization stats
+
+    # Downscaled levels, so inputs with downscale don't resample patches at batch time
+    for level in pyramid_levels[1:]:
+        save_image(image_id, band, downscale_image(tile, level), level, chunked=chunked_images)
+
+
+@timed('filters')
+def compute_filters(data):
+    filter_data = np.zeros((1, data.shape[1], data.shape[2]), dtype=np.float32)
+    filter_data[0] = sobel(np.clip(data[0] / 600.0, 0, 1)) + sobel(np.clip(data[1] / 600.0, 0, 1)) + sobel(np.clip(data[2] / 600.0, 0, 1))
+
+    return filter_data
+
+
+@timed('location')
 def prepare_location(loc):
     print "  Processing %s..." % loc
 
-    data_i, xs_i, ys_i = read_location_images(loc, 'three_band')
-    data_m, xs_m, ys_m = read_location_images(loc, 'sixteen_band', 'M')
-    #data_p, xs_p, ys_p = read_location_images(loc, 'sixteen_band', 'P')
+    tiles_i = LocationTiles(loc, 'three_band')
+    tiles_m = LocationTiles(loc, 'sixteen_band', 'M', collect_histograms=True)
+
+    # P and A bands are resampled per tile to I and M grids, so they are aligned with them at x1 and x4
+    tiles_p = LocationTiles(loc, 'sixteen_band', 'P', resample_to=tiles_i)
+    tiles_a = LocationTiles(loc, 'sixteen_band', 'A', resample_to=tiles_m)
+
+    try:
+        write_location_images(loc, tiles_i, tiles_m, tiles_p, tiles_a)
+    finally:
+        tiles_p.close()
+        tiles_a.close()
 
+
+def write_location_images(loc, tiles_i, tiles_m, tiles_p, tiles_a):
     # Prepare images
     for i in xrange(n_location_images):
         for j in xrange(n_location_images):
             meta = {
-                'shape': (0, ys_i[i+1] - ys_i[i], xs_i[j+1] - xs_i[j]),
-                'shape_i': (data_i.shape[0], ys_i[i+1] - ys_i[i], xs_i[j+1] - xs_i[j]),
-                'shape_m': (data_m.shape[0], ys_m[i+1] - ys_m[i], xs_m[j+1] - xs_m[j]),
-                #'shape_p': (data_p.shape[0], ys_p[i+1] - ys_p[i], xs_p[j+1] - xs_p[j])
+                'shape': (0,) + tiles_i.tile_shape(i, j),
+                'shape_i': (tiles_i.n_channels,) + tiles_i.tile_shape(i, j),
+                'shape_m': (tiles_m.n_channels,) + tiles_m.tile_shape(i, j),
             }
 
             save_pickle('cache/meta/%s_%d_%d.pickle' % (loc, i, j), meta)
 
-    write_location_images(loc, data_i, xs_i, ys_i, 'I')
-    write_location_images(loc, data_m, xs_m, ys_m, 'M')
-    #write_location_images(loc, data_p, xs_p, ys_p, 'P')
+    # Location-wide percentiles for MN band, from histograms accumulated while reading tiles
+    m_low, m_high = tiles_m.percentiles([1, 99])
+
+    for i in xrange(n_location_images):
+        for j in xrange(n_location_images):
+            image_id = '%s_%d_%d' % (loc, i, j)
+
+            # One extra pixel of border so sobel filter sees real neighbours at the tile border
+            data_i = tiles_i.read_window(i, j, image_border + 1)
+
+            write_tile_image(image_id, 'I', crop(data_i, 1).astype(np.float64))
+            write_tile_image(image_id, 'IF', crop(compute_filters(data_i), 1))
+
+            data_m = tiles_m.read_window(i, j)
+
+            write_tile_image(image_id, 'M', data_m.astype(np.float64))
+            write_tile_image(image_id, 'MN', normalize(data_m, m_low, m_high))  # Location-normalized M channels
+
+            # Derived index bands from util.indices registry
+            for band, data in compute_index_bands(data_m).items():
+                write_tile_image(image_id, band, data)
 
-    write_location_images(loc, normalize(data_m), xs_m, ys_m, 'MN')  # Write location-normalized M channels
+            # Resampled bands are stored in their source uint16 dtype
+            write_tile_image(image_id, 'P', tiles_p.read_window(i, j))
+            write_tile_image(image_id, 'A', tiles_a.read_window(i, j))
 
-    write_location_images(loc, compute_filters(data_i), xs_i, ys_i, 'IF')
-    write_location_images(loc, compute_indices(data_m), xs_m, ys_m, 'MI')
 
-    #data_a, xs_a, ys_a = read_location_images(loc, 'sixteen_band', 'A', resize_to='shape_m')
+def run_prepare_location(loc):
+    prepare_location(loc)
 
-    #write_location_images(loc, data_a, xs_a, ys_a, 'A')
+    return pop_spans()  # Pass timings from worker process to main one
 
 
 print "Preparing image data..."
 
-# Prepare locations
-Parallel(n_jobs=2)(delayed(prepare_location)(loc) for loc in locations)
+# Prepare locations, each worker holds only a few tiles at a time, so all locations can run in parallel
+for location_spans in Parallel(n_jobs=-1)(delayed(run_prepare_location)(loc) for loc in locations):
+    add_spans(location_spans)
 
 print "Done."
@@ -1,7 +1,8 @@
 from util.meta import n_classes
 from util.data import train_wkt, grid_sizes
 from util.masks import poly_to_mask
-from util import load_pickle
+from util.cache import load_meta
+from util.pyramid import pyramid_levels, level_suffix, downscale_image
 
 import numpy as np
 
@@ -19,7 +20,7 @@ for image_id, image_cls_wkt in train_wkt.groupby('image_id'):
     xmax = grid_sizes.loc[image_id, 'xmax']
     ymin = grid_sizes.loc[image_id, 'ymin']
 
-    meta = load_pickle('cache/meta/%s.pickle' % image_id)
+    meta = load_meta(image_id)
 
     mask = np.zeros((n_classes, meta['shape'][1], meta['shape'][2]), dtype=np.float32)
 
@@ -31,4 +32,8 @@ for image_id, image_cls_wkt in train_wkt.groupby('image_id'):
 
     np.save('cache/masks/%s.npy' % image_id, mask)
 
+    # Downscaled masks for presets with mask_downscale
+    for level in pyramid_levels[1:]:
+        np.save('cache/masks/%s%s.npy' % (image_id, level_suffix(level)), downscale_image(mask, level, border=0))
+
 print "Done."
@@ -3,6 +3,8 @@ import numpy as np
 from util.meta import n_classes, class_names
 from util.masks import mask_to_poly
 from util.data import grid_sizes, train_wkt
+from util.preds import load_prediction
+from util.cache import load_mask
 
 import shapely.wkt
 
@@ -32,8 +34,8 @@ def poly_jaccard(true_poly, pred_poly):
 def analyze_prediction(image_id, pred_id):
     xymax = (grid_sizes.loc[image_id, 'xmax'], grid_sizes.loc[image_id, 'ymin'])
 
-    mask = np.load('cache/masks/%s.npy' % image_id)
-    pred = np.load('cache/preds/%s.npy' % pred_id)
+    mask = load_mask(image_id)
+    pred = load_prediction(pred_id)
 
     pixel_jacs = np.zeros(n_classes)
     poly_jacs = np.zeros(n_classes)
@@ -0,0 +1,145 @@
+import numpy as np
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+from util.data import sample_submission
+from util.meta import n_classes, full_train_image_ids, class_names
+from util.preds import pred_filename, save_prediction, load_prediction, load_prediction_info
+from util.cache import save_sparse_mask
+from util.timing import pop_spans, add_spans
+
+from model import ModelPipeline
+from model.presets import presets
+
+
+parser = argparse.ArgumentParser(description='Generate pseudo-label masks for test images from model ensemble')
+parser.add_argument('presets', type=str, nargs='+', help='model presets of ensemble')
+parser.add_argument('--split', type=str, default='full', help='model split to use (val or full)')
+parser.add_argument('--threshold', type=float, default=0.9, help='min mean probability of confident positive pixel')
+parser.add_argument('--negative-threshold', type=float, default=0.1, help='max mean probability of confident negative pixel')
+parser.add_argument('--max-uncertain', type=float, default=0.02, help='max fraction of uncertain pixels of any class, images above it are skipped')
+parser.add_argument('--jobs', type=int, default=4, help='number of worker processes')
+
+
+args = parser.parse_args()
+
+models = {}
+
+
+def load_model(preset_name):
+    # Models are loaded lazily in each worker process
+    if preset_name not in models:
+        pipeline = ModelPipeline('%s-%s' % (preset_name, args.split), **dict((k, v) for k, v in presets[preset_name].items() if k not in ['train', 'init']))
+        pipeline.load()
+
+        models[preset_name] = pipeline
+
+    return models[preset_name]
+
+
+def ensemble_prediction(image_id):
+    # Mean of class probabilities over models predicting the class, reusing cached predictions
+    pred_sum = None
+    pred_count = np.zeros(n_classes)
+
+    for preset_name in args.presets:
+        pred_id = '%s-%s-%s' % (image_id, preset_name, args.split)
+
+        if os.path.exists(pred_filename(pred_id)):
+            pred = load_prediction(pred_id)
+            classes = load_prediction_info(pred_id).get('classes', range(n_classes))
+        else:
+            pipeline = load_model(preset_name)
+            pred = pipeline.predict(image_id)
+            classes = list(pipeline.classes)
+
+            save_prediction(pred_id, pred, model=pipeline.name, weights_hash=pipeline.weights_hash(), classes=classes)
+
+        if pred_sum is None:
+            pred_sum = np.zeros(pred.shape, dtype=np.float32)
+
+        pred_sum[classes] += pred[classes]
+        pred_count[classes] += 1
+
+    return pred_sum, pred_count
+
+
+def label_image(image_id):
+    start_time = time.time()
+
+    pred_sum, pred_count = ensemble_prediction(image_id)
+    classes = np.flatnonzero(pred_count)
+
+    pred = pred_sum[classes] / pred_count[classes, np.newaxis, np.newaxis]
+
+    positive = pred >= args.threshold
+    uncertain = ((pred > args.negative_threshold) & ~positive).mean(axis=(1, 2))
+
+    # Uncertain pixels would be trained as negatives, so skip images with many of them
+    if uncertain.max() <= args.max_uncertain:
+        mask = np.zeros((n_classes,) + pred.shape[1:], dtype=np.bool)
+        mask[classes] = positive
+
+        # Classes not predicted by ensemble are empty in mask, so covered ones are stored to not train them as negatives
+        save_sparse_mask(image_id, mask, classes)
+
+        written = True
+    else:
+        written = False
+
+    info = {
+        'written': written,
+        'classes': [int(cls) for cls in classes],
+        'positive': dict((int(cls), float(f)) for cls, f in zip(classes, positive.mean(axis=(1, 2)))),
+        'uncertain': dict((int(cls), float(f)) for cls, f in zip(classes, uncertain)),
+    }
+
+    return image_id, info, time.time() - start_time, pop_spans()
+
+
+print "Generating pseudo-labels with %s..." % ', '.join(args.presets)
+
+image_ids = sorted(set(sample_submission['ImageId'].unique()) - set(full_train_image_ids))
+
+pool = multiprocessing.Pool(args.jobs)
+
+images = {}
+
+for image_id, info, duration, image_spans in pool.imap_unordered(label_image, image_ids):
+    add_spans(image_spans)
+
+    images[image_id] = info
+
+    print "  %s: %s in %d seconds, max uncertain %.4f" % (image_id, 'written' if info['written'] else 'skipped', duration, max(info['uncertain'].values()))
+
+pool.close()
+pool.join()
+
+labelled_image_ids = sorted(image_id for image_id, info in images.items() if info['written'])
+labelled_classes = sorted(reduce(set.intersection, [set(images[image_id]['classes']) for image_id in labelled_image_ids], set(xrange(n_classes))))
+
+with open('cache/masks/pseudo-labels.json', 'w') as f:
+    json.dump({
+        'presets': args.presets,
+        'split': args.split,
+        'threshold': args.threshold,
+        'negative_threshold': args.negative_threshold,
+        'max_uncertain': args.max_uncertain,
+        'image_ids': labelled_image_ids,
+        'classes': labelled_classes,
+        'images': images,
+    }, f, indent=2, sort_keys=True)
+
+print "Labelled %d of %d images, classes %s" % (len(labelled_image_ids), len(image_ids), ', '.join(map(str, labelled_classes)))
+
+for cls in xrange(n_classes):
+    fractions = [info['positive'][cls] for image_id, info in images.items() if info['written'] and cls in info['positive']]
+
+    if fractions:
+        print "Class %d (%s): mean positive fraction %.5f" % (cls, class_names[cls], np.mean(fractions))
+
+print "Done."
@@ -0,0 +1,307 @@
+import numpy as np
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from collections import deque
+
+from util.meta import val_train_image_ids, val_test_image_ids
+from util.stats import load_band_stats
+
+from model.presets import presets
+from model.sweep import parse_grid, expand_preset, format_param
+
+
+parser = argparse.ArgumentParser(description='Train variants of preset over parameter grid in parallel processes')
+parser.add_argument('preset', type=str, help='base model preset')
+parser.add_argument('--grid', type=str, nargs='+', default=[], help='grid options, like train.*.batch_size=32,64 or train.0.optimizer.lr=1e-3,3e-4')
+parser.add_argument('--name', type=str, help='sweep name, base preset name by default')
+parser.add_argument('--cpus', type=int, default=multiprocessing.cpu_count(), help='cpu budget of all runs')
+parser.add_argument('--threads', type=int, default=4, help='backend threads of one run, it takes one more cpu for its validation worker')
+parser.add_argument('--memory', type=float, help='memory budget of all runs in GB, 80%% of total memory by default')
+parser.add_argument('--run-memory', type=float, default=12, help='expected memory of one run in GB')
+parser.add_argument('--working-set', type=int, help='train out-of-core, keeping only given number of images in memory of each run, so --run-memory can be lower')
+parser.add_argument('--stop-after', type=int, default=10, help='min epoch of first stage before run can be stopped early')
+parser.add_argument('--stop-margin', type=float, default=0.0, help='stop run if its best val jac is below median of others by this fraction')
+parser.add_argument('--no-stop', action='store_true', help='disable early stopping')
+parser.add_argument('--poll-interval', type=float, default=10, help='scheduler poll interval in seconds')
+parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+
+
+args = parser.parse_args()
+
+sweep_name = args.name or args.preset
+sweep_dir = 'cache/sweeps/%s' % sweep_name
+
+variants = expand_preset(presets[args.preset], parse_grid(args.grid))
+
+
+def variant_name(idx):
+    return '%s-s%02d' % (sweep_name, idx)
+
+
+def result_filename(idx):
+    return '%s/%s.json' % (sweep_dir, variant_name(idx))
+
+
+def stopped_filename(idx):
+    return '%s/%s-stopped.json' % (sweep_dir, variant_name(idx))
+
+
+def jac_filename(idx):
+    return 'cache/models/%s-val-jac.csv' % variant_name(idx)
+
+
+def run_variant(idx):
+    # Validation pass training of one variant, runs in separate process
+    from model import ModelPipeline, validate
+
+    params, preset = variants[idx]
+
+    print "Running %s: %s" % (variant_name(idx), ', '.join('%s=%s' % (k, format_param(v)) for k, v in params.items()))
+
+    preset_opts = dict((k, v) for k, v in preset.items() if k not in ['train', 'init'])
+
+    pipeline = ModelPipeline('%s-val' % variant_name(idx), **preset_opts)
+
+    if 'init' in preset:
+        pipeline.load_weights('%s-val' % preset['init'])
+
+    start_time = time.time()
+
+    for stage, train_preset in enumerate(preset['train']):
+        train_preset = train_preset.copy()
+
+        if 'val_only' in train_preset:
+            del train_preset['val_only']
+
+        if args.working_set:
+            train_preset['working_set'] = args.working_set
+
+        print "Fitting with %s..." % str(train_preset)
+
+        pipeline.fit(val_train_image_ids, val_test_image_ids, stage=stage, **train_preset)
+
+    pipeline.stop_validation()
+
+    class_jacs, class_jacs_int = validate(pipeline, val_test_image_ids)
+
+    with open(result_filename(idx), 'w') as f:
+        json.dump({
+            'jac': float(class_jacs[pipeline.classes].mean()),
+            'jac_int': float(class_jacs_int[pipeline.classes].mean()),
+            'class_jacs': list(class_jacs),
+            'class_jacs_int': list(class_jacs_int),
+            'time': time.time() - start_time,
+        }, f)
+
+
+if args.run is not None:
+    run_variant(args.run)
+    sys.exit(0)
+
+
+def available_memory():
+    # Available memory in GB according to kernel (linux only)
+    try:
+        with open('/proc/meminfo') as f:
+            info = dict((line.split(':')[0], int(line.split()[1])) for line in f)
+
+        return info['MemAvailable'] / 2.0**20, info['MemTotal'] / 2.0**20
+    except (IOError, KeyError):
+        return None, None
+
+
+def load_curve(idx):
+    # Validation jacs of run by (stage, epoch)
+    if not os.path.exists(jac_filename(idx)):
+        return []
+
+    with open(jac_filename(idx)) as f:
+        return [((int(row['stage']), int(row['epoch'])), float(row['jac'])) for row in csv.DictReader(f)]
+
+
+def best_until(curve, point):
+    jacs = [jac for p, jac in curve if p <= point]
+    return max(jacs) if jacs else None
+
+
+def should_stop(idx, curves):
+    """Median stopping rule: run is stopped when its best val jac up to its last validation
+       is below median of best jacs of other runs at the same point.
+       """
+
+    if not curves[idx]:
+        return False
+
+    point = curves[idx][-1][0]
+
+    if point < (0, args.stop_after):
+        return False
+
+    others = [best_until(curve, point) for other_idx, curve in curves.items() if other_idx != idx and curve and curve[-1][0] >= point]
+
+    if len(others) < 2:
+        return False
+
+    return best_until(curves[idx], point) < np.median(others) * (1 - args.stop_margin)
+
+
+def launch(idx):
+    # Validation log of previous attempt would confuse early stopping
+    if os.path.exists(jac_filename(idx)):
+        os.remove(jac_filename(idx))
+
+    env = dict(os.environ, OMP_NUM_THREADS=str(args.threads))
+    log = open('%s/%s.log' % (sweep_dir, variant_name(idx)), 'w')
+
+    # Own process group, so run can be stopped with its validation and data-parallel workers
+    proc = subprocess.Popen([sys.executable] + sys.argv + ['--run', str(idx)], stdout=log, stderr=subprocess.STDOUT, env=env, preexec_fn=os.setsid)
+
+    print "  Started %s (pid %d)" % (variant_name(idx), proc.pid)
+
+    return proc, log, time.time()
+
+
+if not os.path.exists(sweep_dir):
+    os.makedirs(sweep_dir)
+
+avail_memory, total_memory = available_memory()
+memory_budget = args.memory or (total_memory * 0.8 if total_memory is not None else None)
+
+print "Sweep %s: %d variants of %s, budget %d cpus, %s GB memory" % (sweep_name, len(variants), args.preset, args.cpus, '%.1f' % memory_budget if memory_budget is not None else 'unlimited')
+
+with open('%s/variants.json' % sweep_dir, 'w') as f:
+    json.dump(dict((variant_name(idx), dict((k, format_param(v)) for k, v in params.items())) for idx, (params, preset) in enumerate(variants)), f, indent=2, sort_keys=True)
+
+# Runs only read the image cache, so missing band stats are computed before they start
+for band in sorted(set(inp['band'] for params, preset in variants for inp in preset['inputs'].values())):
+    for image_id in val_train_image_ids:
+        load_band_stats(image_id, band)
+
+# Runs finished or stopped by earlier invocation of the sweep are not repeated
+status = {}
+durations = {}
+
+for idx in xrange(len(variants)):
+    for filename, st in [(result_filename(idx), 'done'), (stopped_filename(idx), 'stopped')]:
+        if os.path.exists(filename):
+            with open(filename) as f:
+                durations[idx] = json.load(f)['time']
+
+            status[idx] = st
+            break
+
+pending = deque(idx for idx in xrange(len(variants)) if idx not in status)
+running = {}
+
+# Each run takes its backend threads and a cpu of its validation worker process
+run_cpus = args.threads + 1
+
+# SIGTERM should stop runs too, they are in own process groups and don't get signals of the sweep
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+try:
+    while pending or running:
+        for idx, (proc, log, start_time) in running.items():
+            if proc.poll() is None:
+                continue
+
+            log.close()
+            del running[idx]
+
+            status[idx] = 'done' if proc.returncode == 0 and os.path.exists(result_filename(idx)) else 'failed'
+            durations[idx] = time.time() - start_time
+
+            print "  Finished %s: %s in %d seconds" % (variant_name(idx), status[idx], durations[idx])
+
+        if not args.no_stop:
+            curves = dict((idx, load_curve(idx)) for idx in xrange(len(variants)))
+
+            for idx, (proc, log, start_time) in running.items():
+                if should_stop(idx, curves):
+                    os.killpg(proc.pid, signal.SIGTERM)
+                    proc.wait()
+                    log.close()
+                    del running[idx]
+
+                    point = curves[idx][-1][0]
+
+                    status[idx] = 'stopped'
+                    durations[idx] = time.time() - start_time
+
+                    with open(stopped_filename(idx), 'w') as f:
+                        json.dump({'stage': point[0], 'epoch': point[1], 'best_jac': best_until(curves[idx], point), 'time': durations[idx]}, f)
+
+                    print "  Stopped %s at stage %d epoch %d, best val jac %.5f" % ((variant_name(idx),) + point + (best_until(curves[idx], point),))
+
+        while pending:
+            used_memory = len(running) * args.run_memory
+            avail_memory, _ = available_memory()
+
+            if running and (len(running) + 1) * run_cpus > args.cpus:
+                break
+
+            if running and memory_budget is not None and used_memory + args.run_memory > memory_budget:
+                break
+
+            if running and avail_memory is not None and avail_memory < args.run_memory:
+                break
+
+            idx = pending.popleft()
+            running[idx] = launch(idx)
+
+        time.sleep(args.poll_interval)
+finally:
+    # Interrupted sweep shouldn't leave orphaned runs
+    for idx, (proc, log, start_time) in running.items():
+        if proc.poll() is None:
+            print "  Killing %s..." % variant_name(idx)
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait()
+
+        log.close()
+
+# Results table
+rows = []
+for idx, (params, preset) in enumerate(variants):
+    row = dict(('param %s' % k, format_param(v)) for k, v in params.items())
+    row.update({'variant': variant_name(idx), 'status': status.get(idx, 'failed'), 'time': '%d' % durations.get(idx, 0)})
+
+    curve = load_curve(idx)
+
+    if curve:
+        point, jac = max(curve, key=lambda c: c[1])
+        row.update({'best_jac': '%.5f' % jac, 'best_stage': point[0], 'best_epoch': point[1]})
+
+    if os.path.exists(result_filename(idx)):
+        with open(result_filename(idx)) as f:
+            res = json.load(f)
+
+        row.update({'final_jac': '%.5f' % res['jac'], 'final_jac_int': '%.5f' % res['jac_int']})
+
+    rows.append(row)
+
+rows.sort(key=lambda row: row.get('final_jac', row.get('best_jac', '')), reverse=True)
+
+fields = ['variant', 'status', 'final_jac', 'final_jac_int', 'best_jac', 'best_stage', 'best_epoch', 'time'] + ['param %s' % k for k in variants[0][0].keys()]
+
+with open('%s/results.csv' % sweep_dir, 'w') as f:
+    writer = csv.DictWriter(f, fields)
+    writer.writeheader()
+
+    for row in rows:
+        writer.writerow(row)
+
+for row in rows:
+    print "  %s: %s, final jac %s, best val jac %s, %s" % (row['variant'], row['status'], row.get('final_jac', '-'), row.get('best_jac', '-'), ', '.join('%s=%s' % (k[6:], row[k]) for k in fields if k.startswith('param ')))
+
+print "Results saved to %s/results.csv" % sweep_dir
+print "Done."
@@ -3,6 +3,7 @@ import numpy as np
 from util.meta import full_train_image_ids
 from util.data import sample_submission, grid_sizes
 from util.masks import mask_to_poly
+from util.cache import load_mask
 
 from skimage.morphology import disk, binary_opening, binary_closing
 
@@ -29,7 +30,7 @@ for image_id in full_train_image_ids:
 
     img = tiff.imread('../input/sixteen_band/%s_M.tif' % image_id)
 
-    mask = np.load('cache/masks/%s.npy' % image_id)
+    mask = load_mask(image_id)
     mask = cv2.resize(mask[cls], (img.shape[2], img.shape[1]), interpolation=cv2.INTER_AREA) > 0.5
 
     img_X = img.reshape((img.shape[0], img.shape[1] * img.shape[2])).T
@@ -1,6 +1,7 @@
 import numpy as np
 
 import datetime
+import json
 import time
 import sys
 
@@ -11,6 +12,9 @@ import argparse
 from util.meta import val_train_image_ids, val_test_image_ids, full_train_image_ids, n_classes, class_names
 from util.data import grid_sizes, sample_submission, train_wkt
 from util.masks import mask_to_poly
+from util.preds import save_prediction
+from util.timing import span
+from util.cache import load_mask
 
 from model import ModelPipeline
 from model.presets import presets
@@ -37,6 +41,10 @@ parser.add_argument('--no-predict', action='store_true', help='skip model predic
 parser.add_argument('--no-val', action='store_true', help='skip validation pass')
 parser.add_argument('--no-full', action='store_true', help='skip full pass')
 parser.add_argument('--cont', type=int, help='load prev weights and continue optimization from given train stage')
+parser.add_argument('--resume', action='store_true', help='resume interrupted training from last saved training state')
+parser.add_argument('--working-set', type=int, help='train out-of-core, keeping only given number of images in memory')
+parser.add_argument('--workers', type=int, help='train in given number of data-parallel processes')
+parser.add_argument('--pseudo-labels', action='store_true', help='also train on test images labelled by pseudo-label.py in full pass')
 
 
 args = parser.parse_args()
@@ -45,31 +53,59 @@ preset_name = args.preset
 preset = presets[preset_name]
 
 preset_opts = dict((k, v) for k, v in preset.items() if k not in ['train', 'init'])
-preset_train_stages = preset['train'][args.cont or 0:]
+preset_train_stages = list(enumerate(preset['train']))[args.cont or 0:]
 
 print "Using preset: %s" % preset_name
 
+pseudo_image_ids = []
+
+if args.pseudo_labels:
+    with open('cache/masks/pseudo-labels.json') as f:
+        pseudo_labels = json.load(f)
+
+    # Classes not covered by pseudo-labels are empty in their masks and would be trained as absent
+    missing_classes = sorted(set(preset_opts.get('classes', range(n_classes))) - set(pseudo_labels.get('classes', [])))
+
+    if missing_classes:
+        raise ValueError("Pseudo-labels don't cover classes %s of preset %s" % (', '.join(map(str, missing_classes)), preset_name))
+
+    pseudo_image_ids = pseudo_labels['image_ids']
+
+    print "Using %d pseudo-labelled images in full pass" % len(pseudo_image_ids)
+
 # Validation pass
 if not args.no_val:
     print "Validation pass..."
 
     pipeline = ModelPipeline('%s-val' % preset_name, **preset_opts)
+    resume_state = pipeline.load_training_state() if args.resume else None
 
-    if args.no_train or args.cont:
+    if args.no_train or args.cont or resume_state is not None:
         pipeline.load()
     elif 'init' in preset:
         pipeline.load_weights('%s-val' % preset['init'])
 
     if not args.no_train:
-        for train_preset in preset_train_stages:
+        for stage, train_preset in preset_train_stages:
             train_preset = train_preset.copy()
 
+            if resume_state is not None and stage < resume_state['stage']:
+                continue
+
             if 'val_only' in train_preset:
                 del train_preset['val_only']
 
+            if args.working_set:
+                train_preset['working_set'] = args.working_set
+
+            if args.workers:
+                train_preset['n_workers'] = args.workers
+
             print "Fitting with %s..." % str(train_preset)
 
-            pipeline.fit(val_train_image_ids, val_test_image_ids, **train_preset)
+            pipeline.fit(val_train_image_ids, val_test_image_ids, stage=stage, resume_state=resume_state if resume_state is not None and stage == resume_state['stage'] else None, **train_preset)
+
+        pipeline.stop_validation()
 
     if not args.no_predict:
 
@@ -79,15 +115,17 @@ if not args.no_val:
         poly_intersections = np.zeros(n_classes)
         poly_unions = np.zeros(n_classes) + 1e-12
 
+        weights_hash = pipeline.weights_hash()
+
         for image_id in val_test_image_ids:
             sys.stdout.write("  Processing %s... " % (image_id))
             sys.stdout.flush()
 
             start_time = time.time()
 
-            mask = np.load('cache/masks/%s.npy' % image_id)
+            mask = load_mask(image_id)
             pred = pipeline.predict(image_id)
-            np.save('cache/preds/%s-%s.npy' % (image_id, preset_name), pred)
+            save_prediction('%s-%s' % (image_id, preset_name), pred, model=pipeline.name, weights_hash=weights_hash, classes=list(pipeline.classes))
 
             xymax = (grid_sizes.loc[image_id, 'xmax'], grid_sizes.loc[image_id, 'ymin'])
 
@@ -124,8 +162,9 @@ if not args.no_full:
     print "Full pass..."
 
     pipeline = ModelPipeline('%s-full' % preset_name, **preset_opts)
+    resume_state = pipeline.load_training_state() if args.resume else None
 
-    if args.no_train or args.cont:
+    if args.no_train or args.cont or resume_state is not None:
         pipeline.load()
     elif 'init' in preset:
         pipeline.load_weights('%s-full' % preset['init'])
@@ -133,22 +172,33 @@ if not args.no_full:
         pipeline.load_weights('%s-val' % preset_name)
 
     if not args.no_train:
-        for train_preset in preset_train_stages:
+        for stage, train_preset in preset_train_stages:
             train_preset = train_preset.copy()
 
+            if resume_state is not None and stage < resume_state['stage']:
+                continue
+
             if 'val_only' in train_preset:
                 continue
 
+            if args.working_set:
+                train_preset['working_set'] = args.working_set
+
+            if args.workers:
+                train_preset['n_workers'] = args.workers
+
             if train_preset.get('epoch_batches', 'grid') != 'grid':
                 train_preset['n_epoch'] = int(train_preset['n_epoch'] * len(full_train_image_ids) / len(val_train_image_ids))
 
             print "Fitting with %s..." % str(train_preset)
 
-            pipeline.fit(full_train_image_ids, **train_preset)
+            pipeline.fit(full_train_image_ids + pseudo_image_ids, stage=stage, resume_state=resume_state if resume_state is not None and stage == resume_state['stage'] else None, **train_preset)
 
     if not args.no_predict:
         subm = sample_submission.copy()
 
+        weights_hash = pipeline.weights_hash()
+
         for image_id in sorted(subm['ImageId'].unique()):
             start_time = time.time()
 
@@ -156,6 +206,8 @@ if not args.no_full:
             sys.stdout.flush()
 
             mask = pipeline.predict(image_id)
+            save_prediction('%s-%s-full' % (image_id, preset_name), mask, model=pipeline.name, weights_hash=weights_hash, classes=list(pipeline.classes))
+
             xymax = (grid_sizes.loc[image_id, 'xmax'], grid_sizes.loc[image_id, 'ymin'])
 
             for cls in subm.loc[subm['ImageId'] == image_id, 'ClassType'].unique():
@@ -167,7 +219,8 @@ if not args.no_full:
         sys.stdout.flush()
 
         subm_name = 'subm-%s-%s' % (preset_name, datetime.datetime.now().strftime('%Y%m%d-%H%M'))
-        subm.to_csv('subm/%s.csv.gz' % subm_name, index=False, compression='gzip')
+        with span('write'):
+            subm.to_csv('subm/%s.csv.gz' % subm_name, index=False, compression='gzip')
 
         print "Done, submission name: %s" % subm_name
 
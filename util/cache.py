@@ -0,0 +1,176 @@
+import numpy as np
+
+import os
+import threading
+
+from collections import OrderedDict
+
+from . import load_pickle
+from .pyramid import level_suffix, downscale_image
+from .chunked import ChunkedArray, save_chunked
+
+
+def value_nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, dict):
+        return sum(value_nbytes(v) for v in value.values())
+    elif isinstance(value, (list, tuple)):
+        return sum(value_nbytes(v) for v in value)
+    else:
+        return 0
+
+
+class LRUCache(object):
+    """In-process cache evicting least recently used values when
+       total size of numpy arrays in it exceeds max_bytes.
+       """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+
+            item = self.items.pop(key)
+            self.items[key] = item
+
+            return item[0]
+
+    def put(self, key, value):
+        size = value_nbytes(value)
+
+        if size > self.max_bytes:
+            return value
+
+        with self.lock:
+            if key in self.items:
+                self.nbytes -= self.items.pop(key)[1]
+
+            self.items[key] = (value, size)
+            self.nbytes += size
+
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self.items.popitem(last=False)
+                self.nbytes -= evicted_size
+
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {'items': len(self.items), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses}
+
+
+# Shared cache of image, mask and meta arrays, returned arrays are read-only. Images and masks are
+# kept only when caller asks for it (training and validation, which reuse them), streaming passes
+# over many images just read through it
+array_cache = LRUCache(4 * 2**30)
+
+# Decoded chunks of chunked images
+chunk_cache = LRUCache(2**30)
+
+
+def cached(key, load, cache=True):
+    # Cached value is returned even if cache is False, but newly loaded one is then not kept
+    value = array_cache.get(key)
+
+    if value is None:
+        value = load()
+
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+
+        if cache:
+            array_cache.put(key, value)
+
+    return value
+
+
+def image_filename(image_id, band, level=1, chunked=False):
+    return 'cache/images/%s_%s%s.%s' % (image_id, band, level_suffix(level), 'chunked' if chunked else 'npy')
+
+
+def save_image(image_id, band, img, level=1, chunked=False):
+    if chunked:
+        save_chunked(image_filename(image_id, band, level, chunked=True), img)
+    else:
+        np.save(image_filename(image_id, band, level), img)
+
+
+def load_image(image_id, band, level=1, cache=False):
+    def load():
+        # Chunked images are read lazily, by chunks intersecting requested patches
+        if os.path.exists(image_filename(image_id, band, level, chunked=True)):
+            return ChunkedArray(image_filename(image_id, band, level, chunked=True), chunk_cache)
+
+        if level > 1 and not os.path.exists(image_filename(image_id, band, level)):
+            return downscale_image(load_image(image_id, band), level)  # Pyramid level wasn't prepared
+
+        return np.load(image_filename(image_id, band, level))
+
+    return cached(('image', image_id, band, level), load, cache)
+
+
+def open_image(image_id, band, level=1):
+    # Disk-backed image for out-of-core access, bypasses array cache
+    if os.path.exists(image_filename(image_id, band, level, chunked=True)):
+        return ChunkedArray(image_filename(image_id, band, level, chunked=True), chunk_cache)
+
+    if level > 1 and not os.path.exists(image_filename(image_id, band, level)):
+        return load_image(image_id, band, level)
+
+    return np.load(image_filename(image_id, band, level), mmap_mode='r')
+
+
+def save_sparse_mask(image_id, mask, classes):
+    # Binary mask stored as flat indices of positive pixels of each class, used for pseudo-labels, with list of labelled classes
+    np.savez_compressed('cache/masks/%s.npz' % image_id, shape=np.array(mask.shape), classes=np.array(classes, dtype=np.int32), **dict(('c%d' % c, np.flatnonzero(mask[c]).astype(np.uint32)) for c in xrange(mask.shape[0])))
+
+
+def load_sparse_mask(filename):
+    # Labels are binary, so mask is kept as uint8 to take a quarter of float32 memory
+    data = np.load(filename)
+
+    try:
+        shape = tuple(data['shape'])
+        mask = np.zeros(shape, dtype=np.uint8)
+
+        for c in xrange(shape[0]):
+            mask[c].flat[data['c%d' % c]] = 1
+    finally:
+        data.close()
+
+    return mask
+
+
+def load_mask(image_id, level=1, cache=False):
+    def load():
+        filename = 'cache/masks/%s%s.npy' % (image_id, level_suffix(level))
+
+        if level > 1 and not os.path.exists(filename):
+            return downscale_image(load_mask(image_id), level, border=0)
+
+        if not os.path.exists(filename) and os.path.exists('cache/masks/%s.npz' % image_id):
+            return load_sparse_mask('cache/masks/%s.npz' % image_id)
+
+        return np.load(filename)
+
+    return cached(('mask', image_id, level), load, cache)
+
+
+def load_meta(image_id):
+    return cached(('meta', image_id), lambda: load_pickle('cache/meta/%s.pickle' % image_id))
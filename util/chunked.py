@@ -0,0 +1,223 @@
+# Chunked compressed image format: image is split to spatial chunks (all channels together),
+# each compressed separately, so reading a patch decodes only the chunks it intersects.
+#
+# File layout: magic, uint32 header length, json header (shape, dtype, chunk size, compression,
+# chunk offsets and lengths in row-major chunk order), compressed chunk data.
+
+import numpy as np
+
+import json
+import os
+import struct
+import zlib
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+
+magic = 'DSTLCHK1'
+
+default_chunk_size = 256
+
+
+def compress(data, compression, itemsize):
+    if compression is None:
+        return data
+    elif compression == 'zlib':
+        return zlib.compress(data, 1)
+    elif compression == 'lz4':
+        return lz4_block.compress(data, store_size=True)
+    elif compression == 'blosc':
+        return blosc.compress(data, typesize=itemsize, cname='lz4')
+    else:
+        raise ValueError("Unknown compression: %s" % compression)
+
+
+def decompress(data, compression):
+    if compression is None:
+        return data
+    elif compression == 'zlib':
+        return zlib.decompress(data)
+    elif compression == 'lz4':
+        return lz4_block.decompress(data)
+    elif compression == 'blosc':
+        return blosc.decompress(data)
+    else:
+        raise ValueError("Unknown compression: %s" % compression)
+
+
+def available_compressions():
+    return [None, 'zlib'] + (['lz4'] if lz4_block is not None else []) + (['blosc'] if blosc is not None else [])
+
+
+def default_compression():
+    # Fastest available codec
+    if blosc is not None:
+        return 'blosc'
+    elif lz4_block is not None:
+        return 'lz4'
+    else:
+        return 'zlib'
+
+
+def save_chunked(filename, img, chunk_size=default_chunk_size, compression='default'):
+    if compression == 'default':
+        compression = default_compression()
+
+    img = np.asarray(img)
+
+    chunks = []
+    offset = 0
+
+    data = []
+    for y in xrange(0, img.shape[1], chunk_size):
+        for x in xrange(0, img.shape[2], chunk_size):
+            chunk = compress(np.ascontiguousarray(img[:, y:y+chunk_size, x:x+chunk_size]).tostring(), compression, img.dtype.itemsize)
+
+            chunks.append((offset, len(chunk)))
+            data.append(chunk)
+
+            offset += len(chunk)
+
+    header = json.dumps({
+        'shape': img.shape,
+        'dtype': img.dtype.str,
+        'chunk_size': chunk_size,
+        'compression': compression,
+        'chunks': chunks,
+    })
+
+    # Write to temporary file first, so readers never see partially written file
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(magic)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+
+        for chunk in data:
+            f.write(chunk)
+
+    os.rename(filename + '.tmp', filename)
+
+
+class ChunkedArray(object):
+    """Read-only array-like view of chunked image file. Slicing with integers and
+       unit-step slices decodes only chunks intersecting the requested window,
+       decoded chunks are kept in given chunk_cache (util.cache.LRUCache).
+       """
+
+    ndim = 3
+
+    def __init__(self, filename, chunk_cache=None):
+        self.filename = filename
+        self.chunk_cache = chunk_cache
+
+        with open(filename, 'rb') as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError("%s is not a chunked image file" % filename)
+
+            header_len = struct.unpack('<I', f.read(4))[0]
+            header = json.loads(f.read(header_len))
+
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(str(header['dtype']))
+        self.chunk_size = header['chunk_size']
+        self.compression = header['compression']
+        self.chunks = header['chunks']
+
+        self.data_offset = len(magic) + 4 + header_len
+        self.n_chunk_cols = (self.shape[2] + self.chunk_size - 1) // self.chunk_size
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        res = self[:, :, :]
+        return res if dtype is None else res.astype(dtype)
+
+    def astype(self, dtype):
+        return self[:, :, :].astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if len(key) > self.ndim:
+            raise IndexError("Too many indices")
+
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        bounds = []
+        squeeze = []
+
+        for axis, k in enumerate(key):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(self.shape[axis])
+
+                if step != 1:
+                    raise IndexError("Only unit-step slices are supported")
+
+                bounds.append((start, max(start, stop)))
+            else:
+                k = int(k)
+
+                if k < 0:
+                    k += self.shape[axis]
+
+                if not 0 <= k < self.shape[axis]:
+                    raise IndexError("Index %d is out of bounds for axis %d" % (k, axis))
+
+                bounds.append((k, k + 1))
+                squeeze.append(axis)
+
+        (c0, c1), (y0, y1), (x0, x1) = bounds
+
+        res = np.empty((c1 - c0, y1 - y0, x1 - x0), dtype=self.dtype)
+
+        cs = self.chunk_size
+
+        for cy in xrange(y0 // cs, (y1 + cs - 1) // cs):
+            for cx in xrange(x0 // cs, (x1 + cs - 1) // cs):
+                chunk = self.read_chunk(cy, cx)
+
+                # Intersection of window with chunk, in image coordinates
+                iy0, iy1 = max(y0, cy * cs), min(y1, (cy + 1) * cs)
+                ix0, ix1 = max(x0, cx * cs), min(x1, (cx + 1) * cs)
+
+                res[:, iy0-y0:iy1-y0, ix0-x0:ix1-x0] = chunk[c0:c1, iy0-cy*cs:iy1-cy*cs, ix0-cx*cs:ix1-cx*cs]
+
+        if squeeze:
+            res = res.reshape([s for axis, s in enumerate(res.shape) if axis not in squeeze])
+
+        return res
+
+    def read_chunk(self, cy, cx):
+        key = (self.filename, cy, cx)
+
+        if self.chunk_cache is not None:
+            chunk = self.chunk_cache.get(key)
+
+            if chunk is not None:
+                return chunk
+
+        offset, length = self.chunks[cy * self.n_chunk_cols + cx]
+
+        with open(self.filename, 'rb') as f:
+            f.seek(self.data_offset + offset)
+            data = decompress(f.read(length), self.compression)
+
+        h = min(self.chunk_size, self.shape[1] - cy * self.chunk_size)
+        w = min(self.chunk_size, self.shape[2] - cx * self.chunk_size)
+
+        chunk = np.frombuffer(data, dtype=self.dtype).reshape((self.shape[0], h, w))
+
+        if self.chunk_cache is not None:
+            self.chunk_cache.put(key, chunk)
+
+        return chunk
@@ -0,0 +1,59 @@
+import numpy as np
+
+from collections import OrderedDict
+
+from .timing import timed
+
+
+# Channels of M band
+m_channels = ['coastal', 'blue', 'green', 'yellow', 'red', 'red_edge', 'nir1', 'nir2']
+
+eps = 1e-3
+
+# Derived bands, computed from M band at prepare time; each is a list of (name, input channels, formula)
+index_bands = OrderedDict()
+
+
+def normalized_difference(a, b):
+    return (a - b) / (a + b + eps)
+
+
+def register_index_band(band, indices):
+    index_bands[band] = indices
+
+
+register_index_band('MI', [
+    ('ndwi', ('green', 'nir1'), normalized_difference),
+    ('ndvi', ('nir1', 'red'), normalized_difference),
+    ('bai', ('nir1', 'blue'), normalized_difference),
+])
+
+register_index_band('MC', [
+    ('ccci', ('red_edge', 'nir2'), normalized_difference),  # Used for water prediction, high over water
+])
+
+
+@timed('indices')
+def compute_index_bands(m, bands=None, chunk_rows=256):
+    """Evaluates registered index bands in one pass over row chunks of M data,
+       each input channel is converted to float32 once per chunk and shared
+       between indices.
+       """
+
+    if bands is None:
+        bands = index_bands.keys()
+
+    res = dict((band, np.empty((len(index_bands[band]), m.shape[1], m.shape[2]), dtype=np.float32)) for band in bands)
+
+    for y in xrange(0, m.shape[1], chunk_rows):
+        inputs = {}
+
+        for band in bands:
+            for k, (name, input_names, formula) in enumerate(index_bands[band]):
+                for input_name in input_names:
+                    if input_name not in inputs:
+                        inputs[input_name] = m[m_channels.index(input_name), y:y+chunk_rows].astype(np.float32)
+
+                res[band][k, y:y+chunk_rows] = formula(*[inputs[input_name] for input_name in input_names])
+
+    return res
@@ -6,6 +6,8 @@ import shapely.affinity
 from shapely.geometry import MultiPolygon, Polygon
 from collections import defaultdict
 
+from .timing import timed
+
 
 def convert_geo_coords_to_raster(coords, raster_size, xymax):
     # __author__ = visoft
@@ -82,6 +84,7 @@ def convert_poly_to_geo_coords(poly, raster_size, xymax):
     return shapely.affinity.scale(poly, xfact=1.0 / x_scaler, yfact=1.0 / y_scaler, origin=(0, 0, 0))
 
 
+@timed('polygonize')
 def mask_to_poly(mask, xymax, epsilon=2, min_area=1., threshold=0.5):
     # __author__ = Konstantin Lopuhin
     # https://www.kaggle.com/lopuhin/dstl-satellite-imagery-feature-detection/full-pipeline-demo-poly-pixels-ml-poly
@@ -0,0 +1,59 @@
+import numpy as np
+
+import json
+import os
+
+from .meta import n_classes
+
+
+def pred_filename(pred_id, ext='npy'):
+    return 'cache/preds/%s.%s' % (pred_id, ext)
+
+
+def save_prediction(pred_id, pred, dtype='float16', **meta):
+    # Save class probabilities with json sidecar, each class is contiguous on disk so it can be memory-mapped separately
+    if dtype == 'uint8':
+        data = np.round(np.clip(pred, 0, 1) * 255).astype(np.uint8)
+    elif dtype == 'float16':
+        data = pred.astype(np.float16)
+    else:
+        raise ValueError("Unknown prediction dtype: %s" % dtype)
+
+    info = dict(meta, dtype=dtype, shape=list(pred.shape))
+
+    np.save(pred_filename(pred_id), np.ascontiguousarray(data))
+
+    with open(pred_filename(pred_id, 'json'), 'w') as f:
+        json.dump(info, f, indent=2, sort_keys=True)
+
+
+def load_prediction_info(pred_id):
+    filename = pred_filename(pred_id, 'json')
+
+    if not os.path.exists(filename):  # Prediction saved before sidecars were introduced
+        return {'dtype': None}
+
+    with open(filename) as f:
+        return json.load(f)
+
+
+def load_prediction(pred_id, classes=None):
+    # Load all classes or only given class (or list of classes) as float32, reading only their part of the file
+    info = load_prediction_info(pred_id)
+    data = np.load(pred_filename(pred_id), mmap_mode='r')
+
+    if classes is not None:
+        stored = info.get('classes')
+
+        # Predictions of single-class models may store only their classes
+        if stored is not None and len(stored) == data.shape[0] and len(stored) != n_classes:
+            classes = stored.index(classes) if np.isscalar(classes) else [stored.index(c) for c in classes]
+
+        data = data[classes]
+
+    res = np.array(data, dtype=np.float32)
+
+    if info['dtype'] == 'uint8':
+        res /= 255.0
+
+    return res
@@ -0,0 +1,31 @@
+import numpy as np
+import cv2
+
+from .meta import image_border
+
+
+# Downscale levels prepared for every band and mask, level 1 is the original image
+pyramid_levels = [1, 2, 4, 8]
+
+
+def level_suffix(level):
+    return '' if level == 1 else '_x%d' % level
+
+
+def downscale_image(img, level, border=image_border):
+    """Area-downsamples image by level. Border is stripped before and re-added by
+       replication after, so downscaled image has the same border width as the
+       original and patch offsets work on it unchanged.
+       """
+
+    inner = img[:, border:img.shape[1]-border, border:img.shape[2]-border]
+
+    h = max(int(round(inner.shape[1] / float(level))), 1)
+    w = max(int(round(inner.shape[2] / float(level))), 1)
+
+    dst = np.empty((img.shape[0], h + 2 * border, w + 2 * border), dtype=np.float32)
+
+    for c in xrange(img.shape[0]):
+        dst[c] = cv2.copyMakeBorder(cv2.resize(inner[c].astype(np.float32), (w, h), interpolation=cv2.INTER_AREA), border, border, border, border, cv2.BORDER_REPLICATE)
+
+    return dst
@@ -0,0 +1,94 @@
+import numpy as np
+import os
+
+from . import load_pickle, save_pickle
+from .cache import open_image
+
+
+def stats_filename(image_id, band):
+    return 'cache/meta/%s_%s_stats.pickle' % (image_id, band)
+
+
+def compute_band_stats(img):
+    n_channels = img.shape[0]
+
+    stats = {
+        'count': np.empty(n_channels, dtype=np.float64),
+        'mean': np.empty(n_channels, dtype=np.float64),
+        'm2': np.empty(n_channels, dtype=np.float64),
+        'min': np.empty(n_channels, dtype=np.float64),
+        'max': np.empty(n_channels, dtype=np.float64),
+        'p1': np.empty(n_channels, dtype=np.float64),
+        'p99': np.empty(n_channels, dtype=np.float64),
+    }
+
+    for c in xrange(n_channels):
+        ch = img[c]
+        mean = ch.mean(dtype=np.float64)
+
+        stats['count'][c] = ch.size
+        stats['mean'][c] = mean
+        stats['m2'][c] = np.square(ch - mean, dtype=np.float64).sum()
+        stats['min'][c] = ch.min()
+        stats['max'][c] = ch.max()
+        stats['p1'][c], stats['p99'][c] = np.percentile(ch, [1, 99])
+
+    return stats
+
+
+def merge_band_stats(stats_list):
+    # Moments are combined with the parallel variance formula (Chan et al.),
+    # percentiles are kept as the widest per-image bounds which is what Normalizer used
+    res = dict((k, v.copy()) for k, v in stats_list[0].items())
+
+    for s in stats_list[1:]:
+        count = res['count'] + s['count']
+        delta = s['mean'] - res['mean']
+
+        res['m2'] = res['m2'] + s['m2'] + delta ** 2 * res['count'] * s['count'] / count
+        res['mean'] = res['mean'] + delta * s['count'] / count
+        res['count'] = count
+
+        res['min'] = np.minimum(res['min'], s['min'])
+        res['max'] = np.maximum(res['max'], s['max'])
+        res['p1'] = np.minimum(res['p1'], s['p1'])
+        res['p99'] = np.maximum(res['p99'], s['p99'])
+
+    return res
+
+
+def uint16_histograms(img):
+    # Per-channel value counts of uint16 image, O(65536) memory per channel regardless of image size
+    return np.array([np.bincount(img[c].ravel(), minlength=2**16) for c in xrange(img.shape[0])], dtype=np.int64)
+
+
+def histogram_percentile(hist, q):
+    # Same linear interpolation between order statistics as np.percentile, so exact for integer data
+    cum = np.cumsum(hist)
+    rank = np.asarray(q, dtype=np.float64) / 100.0 * (cum[-1] - 1)
+
+    lo = np.floor(rank).astype(np.int64)
+    hi = np.minimum(lo + 1, cum[-1] - 1)
+
+    v_lo = np.searchsorted(cum, lo, side='right')
+    v_hi = np.searchsorted(cum, hi, side='right')
+
+    return v_lo + (v_hi - v_lo) * (rank - lo)
+
+
+def save_band_stats(image_id, band, img):
+    stats = compute_band_stats(img)
+    save_pickle(stats_filename(image_id, band), stats)
+    return stats
+
+
+def load_band_stats(image_id, band, img=None):
+    filename = stats_filename(image_id, band)
+
+    if os.path.exists(filename):
+        return load_pickle(filename)
+
+    if img is None:
+        img = open_image(image_id, band)
+
+    return save_band_stats(image_id, band, img)
@@ -0,0 +1,146 @@
+# Lightweight nested timing spans, enabled by setting DSTL_TRACE environment variable:
+#
+#   DSTL_TRACE=1 python train.py ...           - print aggregated table at exit
+#   DSTL_TRACE=trace.json python train.py ...  - also write chrome trace (chrome://tracing)
+#
+# When disabled, span() returns a shared no-op context manager.
+
+import atexit
+import functools
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from collections import defaultdict
+
+
+trace_target = os.environ.get('DSTL_TRACE')
+enabled = bool(trace_target)
+
+spans = []
+
+_local = threading.local()
+
+
+class Span(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+
+        stack.append(self.name)
+
+        self.path = '/'.join(stack)
+        self.start = time.time()
+
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.time() - self.start
+
+        _local.stack.pop()
+        spans.append((self.path, self.start, duration, os.getpid(), threading.current_thread().ident))
+
+        return False
+
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+null_span = NullSpan()
+
+
+def span(name):
+    if not enabled:
+        return null_span
+
+    return Span(name)
+
+
+def timed(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+
+            with Span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def pop_spans():
+    # Take spans recorded so far, used to pass them from worker processes to parent
+    res = spans[:]
+    del spans[:]
+    return res
+
+
+def add_spans(new_spans):
+    spans.extend(new_spans)
+
+
+def summary():
+    totals = defaultdict(float)
+    counts = defaultdict(int)
+
+    for path, start, duration, pid, tid in spans:
+        totals[path] += duration
+        counts[path] += 1
+
+    root_total = sum(t for path, t in totals.items() if '/' not in path) or 1.0
+
+    lines = ["%-50s %8s %12s %10s %7s" % ('span', 'count', 'total, s', 'mean, s', '%')]
+    for path in sorted(totals.keys()):
+        name = '  ' * path.count('/') + path.split('/')[-1]
+        lines.append("%-50s %8d %12.3f %10.4f %6.1f%%" % (name, counts[path], totals[path], totals[path] / counts[path], totals[path] * 100.0 / root_total))
+
+    return '\n'.join(lines)
+
+
+def dump_chrome_trace(filename):
+    start = min(s[1] for s in spans) if spans else 0
+
+    events = [{
+        'name': path.split('/')[-1],
+        'cat': path,
+        'ph': 'X',
+        'ts': (s - start) * 1e6,
+        'dur': duration * 1e6,
+        'pid': pid,
+        'tid': tid,
+    } for path, s, duration, pid, tid in spans]
+
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': events}, f)
+
+
+def report():
+    if not spans or multiprocessing.current_process().name != 'MainProcess':
+        return
+
+    print
+    print summary()
+
+    if trace_target.endswith('.json'):
+        dump_chrome_trace(trace_target)
+        print "Trace written to %s" % trace_target
+
+
+if enabled:
+    atexit.register(report)
@@ -6,6 +6,7 @@ import shapely.wkt
 
 from util.data import sample_submission, grid_sizes
 from util.masks import mask_to_poly, poly_to_mask
+from util.timing import span
 
 from shapely.ops import unary_union
 from shapely.geometry import MultiPolygon
@@ -80,7 +81,8 @@ pixelize = preset.get('pixelize', False)
 
 print "Loading subms..."
 
-subms = [pd.read_csv('subm/%s.csv.gz' % s) for s in subm_names]
+with span('load'):
+    subms = [pd.read_csv('subm/%s.csv.gz' % s) for s in subm_names]
 
 subm = sample_submission.copy()
 
@@ -92,13 +94,15 @@ for image_id in sorted(subm['ImageId'].unique()):
     subm.loc[subm['ImageId'] == image_id, 'MultipolygonWKT'] = 'MULTIPOLYGON EMPTY'
 
     for cls in classes:
-        polys = [shapely.wkt.loads(s.loc[(s['ImageId'] == image_id) & (s['ClassType'] == cls), 'MultipolygonWKT'].iloc[0]) for s in subms]
+        with span('parse'):
+            polys = [shapely.wkt.loads(s.loc[(s['ImageId'] == image_id) & (s['ClassType'] == cls), 'MultipolygonWKT'].iloc[0]) for s in subms]
 
         if pre_buffer_size is not None:
             polys = [p.buffer(pre_buffer_size) for p in polys]
 
         if pixelize:
-            mask = sum(poly_to_mask(p, (18000, 18000), xymax) for p in polys) > len(polys) * 0.5
+            with span('rasterize'):
+                mask = sum(poly_to_mask(p, (18000, 18000), xymax) for p in polys) > len(polys) * 0.5
 
             if 'mask_postprocess' in preset:
                 mask = preset['mask_postprocess'](mask)
@@ -106,13 +110,14 @@ for image_id in sorted(subm['ImageId'].unique()):
             res = mask_to_poly(mask, xymax, min_area=1.0, threshold=1.0)
         else:
             try:
-                poly_parts = []
+                with span('intersect'):
+                    poly_parts = []
 
-                for i in xrange(len(polys)):
-                    for j in xrange(i+1, len(polys)):
-                        poly_parts.append(polys[i].intersection(polys[j]))
+                    for i in xrange(len(polys)):
+                        for j in xrange(i+1, len(polys)):
+                            poly_parts.append(polys[i].intersection(polys[j]))
 
-                res = unary_union(poly_parts)
+                    res = unary_union(poly_parts)
             except:
                 print "Error, using first poly"
                 res = polys[0]
@@ -131,10 +136,12 @@ for image_id in sorted(subm['ImageId'].unique()):
         if not res.is_valid:
             raise ValueError("Invalid geometry")
 
-        subm.loc[(subm['ImageId'] == image_id) & (subm['ClassType'] == cls), 'MultipolygonWKT'] = shapely.wkt.dumps(res, rounding_precision=9)
+        with span('serialize'):
+            subm.loc[(subm['ImageId'] == image_id) & (subm['ClassType'] == cls), 'MultipolygonWKT'] = shapely.wkt.dumps(res, rounding_precision=9)
 
 print "Saving..."
 subm_name = 'vote-%s-%s' % ('+'.join(map(str, classes)), '+'.join(subm_names))
-subm.to_csv('subm/%s.csv.gz' % subm_name, compression='gzip', index=False)
+with span('write'):
+    subm.to_csv('subm/%s.csv.gz' % subm_name, compression='gzip', index=False)
 
 print "Done, %s" % subm_name